@@ -0,0 +1,98 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from feedingester import TakeoverFeedIngester, TakeoverStore
+
+
+class FakeFeedServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Turf takeover feed. Serves at most page_size of the takeovers after afterDate,
+    sorted oldest or newest first. takeovers are (time, zone id, user id) tuples.
+    """
+    def __init__(self, takeovers, page_size: int=250, newest_first: bool=False):
+        super().__init__(('127.0.0.1', 0), FakeFeedHandler)
+        self.takeovers = sorted(takeovers)
+        self.page_size = page_size
+        self.newest_first = newest_first
+        self.requests = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def page(self, after: datetime):
+        takeovers = [takeover for takeover in self.takeovers if takeover[0] > after]
+        if self.newest_first:
+            takeovers.reverse()
+        return [{
+            'type': 'takeover',
+            'time': takeover_time.strftime(TakeoverFeedIngester.TURF_TIME_FORMAT),
+            'zone': {'id': zone_id, 'name': f'Zone{zone_id}', 'latitude': 58.4, 'longitude': 15.6,
+                     'takeoverPoints': 185, 'pointsPerHour': 1},
+            'currentOwner': {'id': user_id, 'name': f'user{user_id}'},
+        } for takeover_time, zone_id, user_id in takeovers[:self.page_size]]
+
+
+class FakeFeedHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        after = parse_qs(urlparse(self.path).query)['afterDate'][0]
+        body = json.dumps(self.server.page(datetime.strptime(after, TakeoverFeedIngester.TURF_TIME_FORMAT))).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def takeover_burst(num_takeovers: int, rng: random.Random, num_zones: int=50):
+    """A quiet quarter of an hour followed by a burst of num_takeovers in one minute, ending a minute ago"""
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    start = now - timedelta(minutes=20)
+    takeovers = set()
+    for k in range(60):
+        takeovers.add((start + timedelta(seconds=15 * k), rng.randrange(num_zones), rng.randrange(100)))
+    while len(takeovers) < 60 + num_takeovers:
+        takeovers.add((now - timedelta(minutes=2, seconds=rng.randrange(60)), rng.randrange(num_zones), rng.randrange(100)))
+    return list(takeovers)
+
+
+def ingest(server: FakeFeedServer, directory: str, name: str, page_size: int):
+    """Poll the fake feed until it has nothing new, returns the ingester"""
+    ingester = TakeoverFeedIngester(base_url=server.url, store=TakeoverStore(os.path.join(directory, f'{name}.db')),
+                                    poll_interval=0.01, min_poll_interval=0.01, page_size=page_size)
+    ingester.run(max_polls=2 * (len(server.takeovers) // page_size) + 5)
+    return ingester
+
+
+if __name__ == "__main__":
+    # Usage: python benchmark_feed.py [NUM_TAKEOVERS] [PAGE_SIZE]
+    # Ingests a burst of takeovers, several pages long, from a local fake feed sorted oldest first and then
+    # newest first, and checks that no takeover is lost or that the lost ones are reported as a gap
+    num_takeovers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    takeovers = takeover_burst(num_takeovers, random.Random(0))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for newest_first in (False, True):
+            server = FakeFeedServer(takeovers, page_size, newest_first)
+            start = time.perf_counter()
+            ingester = ingest(server, directory, 'newest_first' if newest_first else 'oldest_first', page_size)
+            elapsed = time.perf_counter() - start
+            stored = len(ingester.store)
+            print(f"{'Newest' if newest_first else 'Oldest'} first: {stored} of {len(takeovers)} takeovers stored "
+                  f"in {server.requests} requests ({elapsed:.2f} s), {len(takeovers) - stored} lost, "
+                  f"{len(ingester.gaps)} gaps reported")
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,41 @@
+import glob
+import sys
+import time
+
+from zundin_scraper import ZundinScraper
+
+
+def benchmark(parse, html, round_id, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        df = parse(html, round_id)
+    return df, (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    # Usage: python benchmark_parser.py [ROUND_ID PAGE.html [PAGE.html ...]]
+    # Compares the lxml parser with the BeautifulSoup reference on saved zone.php pages,
+    # by default on the sample page in fixtures/ (Ryd, round 167)
+    round_id = int(sys.argv[1]) if len(sys.argv) > 1 else 167
+    filenames = sys.argv[2:] if len(sys.argv) > 2 else sorted(glob.glob('fixtures/zone_*.html'))
+    repeats = 5
+
+    scraper = ZundinScraper()
+    total_soup = 0
+    total_lxml = 0
+    for filename in filenames:
+        with open(filename, 'r', encoding='utf-8') as file:
+            html = file.read()
+
+        soup_df, soup_time = benchmark(scraper._parse_visits_data_soup, html, round_id, repeats)
+        lxml_df, lxml_time = benchmark(scraper._parse_visits_data, html, round_id, repeats)
+        total_soup += soup_time
+        total_lxml += lxml_time
+
+        identical = (soup_df is None and lxml_df is None) or (soup_df is not None and soup_df.equals(lxml_df))
+        rows = 0 if lxml_df is None else len(lxml_df)
+        print(f"{filename}: {rows} rows, soup {soup_time * 1000:.1f} ms, lxml {lxml_time * 1000:.1f} ms, "
+              f"{soup_time / lxml_time:.1f}x, identical: {identical}")
+
+    if filenames:
+        print(f"Total: soup {total_soup * 1000:.1f} ms, lxml {total_lxml * 1000:.1f} ms, {total_soup / total_lxml:.1f}x")
@@ -0,0 +1,133 @@
+import csv
+import random
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+from feedingester import TakeoverStore
+from graph import Graph, Node, _heap_search
+from incrementalsearch import IncrementalSearch
+from turfclasses import Coordinate, User, Zone
+from util import sl_distance
+
+
+class StraightLineRouter:
+    """Stands in for GraphHopperAPI on synthetic graphs, routes are 30% longer than the straight line"""
+    def get_bike_distances(self, pairs):
+        return [{'distance': 1.3 * sl_distance(start, finish)} for start, finish in pairs]
+
+    def get_bike_route(self, start, finish):
+        return None
+
+
+def synthetic_graph(num_zones, rng):
+    """Zones with random values about as dense as in a city (3000 zones on 30 x 30 km), connected like build_graph does"""
+    scale = (num_zones / 3000) ** 0.5
+    zones = [Zone(k, f'Zone{k}', Coordinate(58.3 + rng.random() * 0.27 * scale, 15.4 + rng.random() * 0.5 * scale),
+                  185, 1, datetime(2015, 1, 1), User(0, 'neutral')) for k in range(num_zones)]
+    graph = Graph()
+    graph.gh_api = StraightLineRouter()
+    graph.add_nodes([Node(zone) for zone in zones])
+    graph.values = np.array([rng.uniform(50, 400) for _ in zones])
+    graph.connect(*graph.candidate_edges())
+    return graph
+
+
+def takeover_burst(graph, num_takeovers, rng, takeovers_file='fixtures/takeover_burst.csv'):
+    """
+    Zones taken over in a burst, as node indices, with zone ids mapped onto the synthetic graph. Read from a
+    CSV of (time, zone_id, user_id) rows like the recorded burst in fixtures/, or from a takeovers.db written
+    by feedingester.py. Random if takeovers_file is None.
+    """
+    if takeovers_file is None:
+        return [rng.randrange(len(graph.nodes)) for _ in range(num_takeovers)]
+    if takeovers_file.endswith('.csv'):
+        with open(takeovers_file, newline='') as file:
+            zone_ids = [int(row['zone_id']) for row in csv.DictReader(file)][:num_takeovers]
+    else:
+        zone_ids = [takeover.zone.id for _, takeover in TakeoverStore(takeovers_file).read(limit=num_takeovers)]
+    return [zone_id % len(graph.nodes) for zone_id in zone_ids]
+
+
+def connected_pair(graph):
+    """First node and the node reachable from it that is furthest away in a straight line"""
+    offsets, targets, _ = graph.adjacency()
+    reachable = {0}
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        for target in targets[offsets[node]:offsets[node + 1]]:
+            if target not in reachable:
+                reachable.add(target)
+                stack.append(target)
+    finish = max(reachable, key=lambda node: sl_distance(graph.nodes[0].zone.coordinate, graph.nodes[node].zone.coordinate))
+    return graph.nodes[0], graph.nodes[finish]
+
+
+def path_cost(graph, path):
+    """Cost of a path of nodes, taking the cheapest edge between consecutive nodes"""
+    offsets, targets, edge_costs = graph.adjacency()
+    cost = 0.0
+    for node, next_node in zip(path, path[1:]):
+        cost += min(edge_costs[position] for position in range(offsets[node.index], offsets[node.index + 1])
+                    if targets[position] == next_node.index)
+    return cost
+
+
+if __name__ == "__main__":
+    # Usage: python benchmark_replanning.py [NUM_ZONES] [NUM_TAKEOVERS] [TAKEOVERS_FILE | random]
+    # Replays a burst of takeovers (by default the one in fixtures/), each changing the value of one zone,
+    # and compares repairing the path with IncrementalSearch against updating a copy of the graph and
+    # searching it from scratch
+    num_zones = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    num_takeovers = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    takeovers_file = sys.argv[3] if len(sys.argv) > 3 else 'fixtures/takeover_burst.csv'
+    if takeovers_file == 'random':
+        takeovers_file = None
+    graph = synthetic_graph(num_zones, random.Random(0))
+    full_graph = synthetic_graph(num_zones, random.Random(0))
+    print(f"Graph with {len(graph.nodes)} nodes and {graph.num_edges} edges.")
+    start, finish = connected_pair(graph)
+    rng = random.Random(1)
+
+    search = IncrementalSearch(graph, start, finish)
+    search.path()
+    assert search.cost < float('inf'), "Finish can't be reached from start"
+    print(f"Initial search: cost {search.cost:.1f}, {search.expanded} nodes expanded.")
+
+    total_incremental = 0
+    total_full = 0
+    expanded = 0
+    mismatches = 0
+    different_paths = 0
+    for index in takeover_burst(graph, num_takeovers, rng, takeovers_file):
+        # A takeover resets the hold clock, which changes the value of the zone
+        value = float(graph.values[index]) * rng.uniform(0.5, 1.5)
+
+        timer = time.perf_counter()
+        expanded_before = search.expanded
+        search.update_zone_values({index: value})
+        path = search.path()
+        total_incremental += time.perf_counter() - timer
+        expanded += search.expanded - expanded_before
+
+        timer = time.perf_counter()
+        full_values = full_graph.values.copy()
+        full_values[index] = value
+        full_graph.update_zone_values(full_values)
+        full_path, full_cost = _heap_search(full_graph, full_graph.nodes[start.index], full_graph.nodes[finish.index])
+        total_full += time.perf_counter() - timer
+        # The repaired path has to be as cheap as the one found from scratch, both by the search's own cost
+        # and by summing its edges. Equally cheap paths may still take different nodes
+        if (len(path) == 0) != (len(full_path) == 0):
+            mismatches += 1
+        elif path and not (np.isclose(search.cost, full_cost) and np.isclose(path_cost(graph, path), full_cost)):
+            mismatches += 1
+        if [node.index for node in path] != [node.index for node in full_path]:
+            different_paths += 1
+
+    print(f"{num_takeovers} takeovers: incremental {total_incremental * 1000:.0f} ms "
+          f"({expanded / max(num_takeovers, 1):.1f} nodes expanded per takeover), full search {total_full * 1000:.0f} ms, "
+          f"{mismatches} mismatching costs, {different_paths} different but equally cheap paths.")
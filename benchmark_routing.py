@@ -0,0 +1,120 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import polyline
+
+from graphhopperapi import GraphHopperAPI
+from routestore import RouteStore
+from turfclasses import Coordinate
+
+
+class FakeRoutingServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the GraphHopper /route endpoint. Every request takes latency seconds, routes to
+    coordinates in hang_lats never answer in time and routes to coordinates in error_lats fail with 500.
+    """
+    def __init__(self, latency: float=0.1, hang_lats=(), error_lats=()):
+        super().__init__(('127.0.0.1', 0), FakeRoutingHandler)
+        self.latency = latency
+        self.hang_lats = set(hang_lats)
+        self.error_lats = set(error_lats)
+        self.requests = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+
+class FakeRoutingHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server._lock:
+            self.server.requests += 1
+        points = [(lat, lon) for lon, lat in payload['points']]
+        finish_lat = points[-1][0]
+
+        time.sleep(self.server.latency * (20 if finish_lat in self.server.hang_lats else 1))
+        if finish_lat in self.server.error_lats:
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        encoded = polyline.encode(points, 5)
+        body = json.dumps({'paths': [{'distance': 1000.0, 'time': 200000, 'ascend': 0, 'descend': 0,
+                                      'points_encoded': True, 'points': encoded, 'snapped_waypoints': encoded}]}).encode()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # The client gave up waiting
+
+
+def route_pairs(num_pairs: int):
+    """Distinct (start, finish) pairs around Linköping"""
+    return [(Coordinate(58.4 + k * 0.001, 15.6), Coordinate(58.41 + k * 0.001, 15.62)) for k in range(num_pairs)]
+
+
+def gh_api(server: FakeRoutingServer, directory: str, name: str, **kwargs):
+    """Client for the fake server with an empty route store. Rate limiters are shared per key, so every run gets its own"""
+    return GraphHopperAPI(api_key=name, base_url=server.url, route_store=RouteStore(os.path.join(directory, f'{name}.db')), **kwargs)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    # Usage: python benchmark_routing.py [NUM_PAIRS] [LATENCY]
+    # Fetches routes from a local fake routing server that adds LATENCY seconds per request, one at a time
+    # and with get_bike_routes, then checks the rate limit, the quota, cached routes and failing requests
+    num_pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    pairs = route_pairs(num_pairs)
+    hang, error = pairs[3][1], pairs[5][1]
+    server = FakeRoutingServer(latency, hang_lats=[hang.lat], error_lats=[error.lat])
+    failing = {3, 5}
+
+    with tempfile.TemporaryDirectory() as directory:
+        api = gh_api(server, directory, 'serial', timeout=latency * 5)
+        serial, serial_time = timed(lambda: [api.get_bike_route(start, finish) for start, finish in pairs])
+
+        api = gh_api(server, directory, 'concurrent', max_workers=8, timeout=latency * 5)
+        concurrent, concurrent_time = timed(api.get_bike_routes, pairs)
+        missing = {k for k, route in enumerate(concurrent) if not route}
+        same = all(not a and not b or a['points'] == b['points'] for a, b in zip(serial, concurrent))
+        print(f"{num_pairs} routes with {latency * 1000:.0f} ms latency: serial {serial_time:.2f} s, "
+              f"concurrent {concurrent_time:.2f} s ({serial_time / concurrent_time:.1f}x), "
+              f"failed {sorted(missing)} (expected {sorted(failing)}), same routes: {same}")
+
+        before = server.requests
+        _, cached_time = timed(api.get_bike_routes, pairs)
+        print(f"Cached: {server.requests - before} requests for the {num_pairs - len(failing)} stored routes "
+              f"(failed ones are fetched again), {cached_time:.2f} s")
+
+        requests_per_second = 20
+        api = gh_api(server, directory, 'rate', max_workers=8, requests_per_second=requests_per_second, timeout=latency * 5)
+        _, rate_time = timed(api.get_bike_routes, pairs)
+        print(f"Limited to {requests_per_second} requests/s: {rate_time:.2f} s, "
+              f"at least {(num_pairs - 1) / requests_per_second:.2f} s expected")
+
+        quota = num_pairs // 2
+        api = gh_api(server, directory, 'quota', max_workers=8, quota=quota, timeout=latency * 5)
+        before = server.requests
+        routes = api.get_bike_routes(pairs)
+        print(f"Quota of {quota}: {server.requests - before} requests made, {sum(1 for route in routes if route)} routes")
+
+    server.shutdown()
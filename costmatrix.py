@@ -0,0 +1,139 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import heapq
+import os
+
+import numpy as np
+
+from graph import Graph, Node
+
+
+def graph_fingerprint(graph: Graph, weight: str='cost'):
+    """Hash of the zones and edges of a graph, changes whenever any edge or cost changes"""
+    sha = hashlib.sha1(weight.encode())
+    sha.update(np.array([node.zone.id for node in graph.nodes], dtype=np.int64).tobytes())
+    sha.update(graph.offsets.astype(np.int64).tobytes())
+    sha.update(graph.targets.astype(np.int64).tobytes())
+    sha.update(_edge_weights(graph, weight).tobytes())
+    return sha.hexdigest()[:16]
+
+
+def _edge_weights(graph: Graph, weight: str):
+    """Edge costs, or route distances in meters"""
+    if weight == 'cost':
+        return graph.costs.astype(np.float64)
+    elif weight == 'distance':
+        return graph.distances.astype(np.float64)
+    else:
+        raise ValueError("Invalid edge weight, use 'cost' or 'distance'.")
+
+
+def single_source_costs(offsets, targets, edge_costs, source: int):
+    """Heap Dijkstra from source to every node, returns (costs, predecessors) lists"""
+    n = len(offsets) - 1
+    costs = [float('inf')] * n
+    previous = [-1] * n
+    visited = [False] * n
+
+    costs[source] = 0
+    queue = [(0, source)]
+    while queue:
+        cost, current = heapq.heappop(queue)
+        if visited[current]:
+            continue
+        visited[current] = True
+
+        for position in range(offsets[current], offsets[current + 1]):
+            other = targets[position]
+            new_cost = cost + edge_costs[position]
+            if new_cost < costs[other]:
+                costs[other] = new_cost
+                previous[other] = current
+                heapq.heappush(queue, (new_cost, other))
+
+    return costs, previous
+
+
+# Graph arrays for the worker processes, set once per process by _init_worker
+_worker_adjacency = None
+
+def _init_worker(offsets, targets, edge_costs):
+    global _worker_adjacency
+    _worker_adjacency = (offsets, targets, edge_costs)
+
+
+def _solve_sources(sources):
+    return [single_source_costs(*_worker_adjacency, source) for source in sources]
+
+
+class CostMatrix:
+    """
+    All-pairs shortest path costs and predecessors for a graph, stored as .npy files that are memory-mapped
+    when loaded. costs[i, j] is the cheapest cost from node i to node j, and predecessors[i, j] is the node
+    before j on that path (-1 if j is i or unreachable).
+    With weight='distance', route distances in meters are used instead of edge costs.
+    """
+    def __init__(self, graph: Graph, costs: np.ndarray, predecessors: np.ndarray):
+        self.graph = graph
+        self.costs = costs
+        self.predecessors = predecessors
+
+    @staticmethod
+    def compute(graph: Graph, processes: int=None, chunk_size: int=32, weight: str='cost'):
+        """Run Dijkstra from every node, spread over a process pool"""
+        n = len(graph.nodes)
+        offsets, targets, _ = graph.adjacency()
+        edge_costs = _edge_weights(graph, weight).tolist()
+        costs = np.full((n, n), np.inf)
+        predecessors = np.full((n, n), -1, dtype=np.int32)
+
+        chunks = [range(k, min(k + chunk_size, n)) for k in range(0, n, chunk_size)]
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                 initargs=(offsets, targets, edge_costs)) as executor:
+            for sources, results in zip(chunks, executor.map(_solve_sources, chunks)):
+                for source, (row_costs, row_previous) in zip(sources, results):
+                    costs[source] = row_costs
+                    predecessors[source] = row_previous
+
+        return CostMatrix(graph, costs, predecessors)
+
+    @staticmethod
+    def load_or_compute(graph: Graph, directory: str='cost_matrices', processes: int=None, weight: str='cost'):
+        """Load the cost matrix for this graph from disk, or compute and save it if there is none"""
+        fingerprint = graph_fingerprint(graph, weight)
+        costs_filename = os.path.join(directory, f'{fingerprint}_costs.npy')
+        predecessors_filename = os.path.join(directory, f'{fingerprint}_predecessors.npy')
+
+        if os.path.exists(costs_filename) and os.path.exists(predecessors_filename):
+            print(f"{costs_filename} already exists. Loading from file.")
+            return CostMatrix(graph, np.load(costs_filename, mmap_mode='r'), np.load(predecessors_filename, mmap_mode='r'))
+
+        print(f"{costs_filename} not found. Computing all-pairs costs for {len(graph.nodes)} nodes.")
+        cost_matrix = CostMatrix.compute(graph, processes, weight=weight)
+        os.makedirs(directory, exist_ok=True)
+        np.save(costs_filename, cost_matrix.costs)
+        np.save(predecessors_filename, cost_matrix.predecessors)
+        print(f"  {costs_filename} saved successfully.")
+        return cost_matrix
+
+    def cost(self, start: Node, finish: Node):
+        return float(self.costs[start.index, finish.index])
+
+    def path(self, start: Node, finish: Node):
+        """Cheapest path from start to finish as a list of nodes (empty if unreachable)"""
+        if start.index != finish.index and self.predecessors[start.index, finish.index] < 0:
+            return []
+
+        path = []
+        current = finish.index
+        while current != start.index:
+            path.append(self.graph.nodes[current])
+            current = int(self.predecessors[start.index, current])
+        path.append(start)
+        return path[::-1]
+
+    def best_start(self, finish: Node):
+        """Node with the cheapest path to finish, other than finish itself"""
+        costs = np.array(self.costs[:, finish.index])
+        costs[finish.index] = np.inf
+        return self.graph.nodes[int(np.argmin(costs))]
@@ -0,0 +1,319 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import List
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+import requests
+
+from turfclasses import Coordinate, Round, Takeover, User, Zone
+from visitstore import VisitStore
+from zonecache import ZoneCache
+
+
+class TakeoverStore:
+    """
+    Append-only log of takeovers from the feed in a SQLite file. Every takeover gets a sequence number,
+    and the feed cursor and the last sequence number applied to the caches are stored next to the log,
+    so an ingester can be stopped and restarted at any point without losing or repeating takeovers.
+    """
+    def __init__(self, filename: str='takeovers.db'):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS takeovers (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                time REAL NOT NULL,
+                zone_id INTEGER NOT NULL,
+                zone_name TEXT NOT NULL,
+                lat REAL,
+                lon REAL,
+                takeover_points INTEGER,
+                points_per_hour INTEGER,
+                user_id INTEGER NOT NULL,
+                user_name TEXT NOT NULL,
+                UNIQUE (zone_id, time, user_id)
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS takeovers_zone_time ON takeovers (zone_id, time)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM takeovers").fetchone()[0]
+
+    def append(self, takeovers: List[Takeover], cursor: datetime=None):
+        """Append takeovers that are not in the log yet, and move the cursor in the same transaction. Returns the number appended."""
+        rows = [(takeover.time.timestamp(), takeover.zone.id, takeover.zone.name,
+                 takeover.zone.coordinate.lat, takeover.zone.coordinate.lon,
+                 takeover.zone.takeover_points, takeover.zone.points_per_hour,
+                 takeover.user.id, takeover.user.name) for takeover in sorted(takeovers, key=lambda t: t.time)]
+        with self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany("""
+                INSERT OR IGNORE INTO takeovers
+                (time, zone_id, zone_name, lat, lon, takeover_points, points_per_hour, user_id, user_name)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            appended = self.connection.total_changes - before
+            if cursor is not None:
+                self._set_meta('cursor', cursor.astimezone(timezone.utc).strftime(TakeoverFeedIngester.TURF_TIME_FORMAT))
+        return appended
+
+    def read(self, after_seq: int=0, limit: int=None):
+        """Takeovers with a sequence number after after_seq, as a list of (seq, takeover)"""
+        query = "SELECT * FROM takeovers WHERE seq > ? ORDER BY seq"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        return [(row[0], self._takeover_from_row(row)) for row in self.connection.execute(query, (after_seq,))]
+
+    @property
+    def cursor(self):
+        """Time of the newest takeover seen in the feed, or None before the first poll"""
+        value = self._get_meta('cursor')
+        return datetime.strptime(value, TakeoverFeedIngester.TURF_TIME_FORMAT) if value else None
+
+    @property
+    def applied_seq(self):
+        return int(self._get_meta('applied_seq') or 0)
+
+    @applied_seq.setter
+    def applied_seq(self, seq: int):
+        with self.connection:
+            self._set_meta('applied_seq', str(seq))
+
+    def _get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def _takeover_from_row(self, row):
+        (_, timestamp, zone_id, zone_name, lat, lon, takeover_points, points_per_hour, user_id, user_name) = row
+        user = User(user_id, user_name)
+        zone = Zone(zone_id, zone_name, Coordinate(lat, lon), takeover_points, points_per_hour, None, user)
+        return Takeover(zone, user, datetime.fromtimestamp(timestamp, timezone.utc))
+
+
+class TakeoverFeedIngester:
+    """
+    Polls the Turf takeover feed and appends every takeover to a TakeoverStore, then applies them to the
+    owners in a ZoneCache and to the visit history in a VisitStore (only for zones and rounds that are
+    already stored, so a partial history is never saved as complete).
+
+    The feed only returns page_size takeovers per request, and the cursor moves to the newest one. If a
+    full page is sorted oldest first it ends before the newest takeovers, so the feed is polled again
+    right away from the second the page ended in and nothing is dropped. If it is sorted newest first, the takeovers
+    between the cursor and the oldest one on the page can't be fetched with afterDate, so the gap is
+    logged and kept in gaps. The interval shrinks while the feed is busy and grows back to poll_interval
+    when it is quiet. Polls overlap by a few seconds, duplicates are dropped by the store.
+    """
+    BASE_URL = "https://api.turfgame.com/v4/"
+    TURF_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+    LOCAL_TIMEZONE = ZoneInfo('Europe/Stockholm')   # Visit dates from Zundin and round starts are Swedish time
+
+    def __init__(self, base_url: str=BASE_URL, store: TakeoverStore=None, zone_cache: ZoneCache=None,
+                 visit_store: VisitStore=None, poll_interval: float=60, min_poll_interval: float=5,
+                 page_size: int=250, overlap: timedelta=timedelta(seconds=10), lookback: timedelta=timedelta(minutes=30)):
+        """
+        page_size is the most takeovers the feed returns in one response. On the first run, the feed is
+        read from lookback ago.
+        """
+        self.base_url = base_url
+        self.store = store if store is not None else TakeoverStore()
+        self.zone_cache = zone_cache
+        self.visit_store = visit_store
+        self.poll_interval = poll_interval
+        self.min_poll_interval = min_poll_interval
+        self.page_size = page_size
+        self.overlap = overlap
+        self.lookback = lookback
+        self.interval = poll_interval
+        self.next_wait = poll_interval
+        self.gaps = []      # (cursor, oldest) ranges of the feed that may have had takeovers that were never received
+        self._continue_after = None     # Set after a full page sorted oldest first, where the next page starts
+
+    def run(self, max_polls: int=None, stop_event: threading.Event=None):
+        """Poll the feed until stop_event is set or max_polls polls have been made"""
+        stop_event = stop_event or threading.Event()
+        polls = 0
+        failures = 0
+        while not stop_event.is_set() and (max_polls is None or polls < max_polls):
+            polls += 1
+            result = self.poll_once()
+            if result is None:
+                failures += 1
+                wait = min(self.poll_interval, self.min_poll_interval * 2 ** failures)
+            else:
+                failures = 0
+                wait = self.next_wait
+            if wait > 0:
+                stop_event.wait(wait)
+
+    def poll_once(self):
+        """
+        Fetch the feed from the cursor, append new takeovers to the store and apply them.
+        Returns the takeovers in the response, or None if the request failed. Sets next_wait, the
+        number of seconds until the next poll.
+        """
+        cursor = self.store.cursor or datetime.now(timezone.utc) - self.lookback
+        # Continuing a burst, the page starts at the second the last one ended in instead of overlapping
+        after = self._continue_after if self._continue_after is not None else cursor - self.overlap
+        data = self._fetch_feed(after)
+        if data is None:
+            return None
+
+        takeovers = self._parse_feed(data)
+        full = len(data) >= self.page_size
+        self._check_gap(takeovers, cursor, full)
+        newest = max([cursor] + [takeover.time for takeover in takeovers])
+        oldest_first = len(takeovers) < 2 or takeovers[0].time <= takeovers[-1].time
+        self._continue_after = newest - timedelta(seconds=1) if full and oldest_first and newest > cursor else None
+        appended = self.store.append(takeovers, newest)
+        if appended:
+            print(f"Got {appended} new takeovers, feed cursor at {newest}.")
+
+        self.next_wait = self._next_interval(len(takeovers), appended)
+        self.apply_pending()
+        return takeovers
+
+    def apply_pending(self, batch_size: int=10000):
+        """Apply takeovers that are in the store but not yet applied to the zone cache and visit store"""
+        while True:
+            pending = self.store.read(self.store.applied_seq, limit=batch_size)
+            if not pending:
+                return
+            takeovers = [takeover for _, takeover in pending]
+            if self.zone_cache is not None:
+                self.zone_cache.apply_takeovers(takeovers)
+            if self.visit_store is not None:
+                self._apply_to_visits(takeovers)
+            self.store.applied_seq = pending[-1][0]
+
+    def _check_gap(self, takeovers: List[Takeover], cursor: datetime, full: bool):
+        """
+        A full page sorted newest first that doesn't reach back to the cursor has skipped the takeovers in
+        between. The page order is taken from the first and last takeover.
+        """
+        if not full or len(takeovers) < 2 or takeovers[0].time <= takeovers[-1].time:
+            return
+        oldest = takeovers[-1].time
+        if oldest > cursor:
+            print(f"Feed gap: the feed returned a full page of the newest takeovers, takeovers between {cursor} and {oldest} may be missing.")
+            self.gaps.append((cursor, oldest))
+
+    def _next_interval(self, received: int, appended: int):
+        """Poll again right away after a full page with new takeovers, faster while busy and slower while quiet"""
+        if received >= self.page_size and appended:
+            self.interval = self.min_poll_interval
+            return 0
+        if received >= self.page_size // 2:
+            self.interval = max(self.min_poll_interval, self.interval / 2)
+        else:
+            self.interval = min(self.poll_interval, self.interval * 1.5)
+        return self.interval
+
+    def _fetch_feed(self, after: datetime):
+        """GET the takeover feed after a date, returns the response JSON or None on failure"""
+        url = f"{self.base_url}feeds/takeover"
+        params = {'afterDate': after.astimezone(timezone.utc).strftime(self.TURF_TIME_FORMAT)}
+        try:
+            response = requests.get(url, params=params, timeout=30)
+        except requests.RequestException as e:
+            print(f"Error fetching takeover feed: {e}")
+            return None
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            print(f"Error fetching takeover feed: {response.status_code}")
+            return None
+
+    def _parse_feed(self, data):
+        """Convert feed items into Takeover objects, items of other types are skipped"""
+        takeovers = []
+        for item in data:
+            if item.get('type', 'takeover') != 'takeover':
+                continue
+            zone_data = item['zone']
+            owner = item.get('currentOwner') or zone_data['currentOwner']
+            user = User(owner['id'], owner['name'])
+            zone = Zone(
+                id=zone_data['id'],
+                name=zone_data['name'],
+                coordinate=Coordinate(zone_data['latitude'], zone_data['longitude']),
+                takeover_points=zone_data.get('takeoverPoints'),
+                points_per_hour=zone_data.get('pointsPerHour'),
+                date_created=datetime.strptime(zone_data['dateCreated'], self.TURF_TIME_FORMAT) if 'dateCreated' in zone_data else None,
+                current_owner=user
+            )
+            takeovers.append(Takeover(zone, user, datetime.strptime(item['time'], self.TURF_TIME_FORMAT)))
+        return takeovers
+
+    def _local_time(self, date: datetime):
+        return date.astimezone(self.LOCAL_TIMEZONE).replace(tzinfo=None)
+
+    def _apply_to_visits(self, takeovers: List[Takeover]):
+        """Add takeovers as visits to the stored zones and rounds they belong to"""
+        grouped = {}
+        for takeover in takeovers:
+            visit_date = self._local_time(takeover.time)
+            key = (takeover.zone.name, Round.get_round_id_from_date(visit_date))
+            grouped.setdefault(key, []).append((takeover, visit_date))
+
+        stored = self.visit_store.read_many({zone_name for zone_name, _ in grouped}, {round_id for _, round_id in grouped})
+        now = self._local_time(datetime.now(timezone.utc))
+        updated = {}
+        for key, visits in grouped.items():
+            if key in stored:
+                merged = self._merge_takeovers(stored[key], visits, now)
+                if merged is not None:
+                    updated[key] = merged
+        self.visit_store.write_many(updated)
+
+    def _merge_takeovers(self, visits_df: pd.DataFrame, visits, now: datetime):
+        """
+        Add (takeover, local visit date) pairs to the visits of a zone, newest first like the scraped pages.
+        Hold times of takeovers from the one before the first new takeover onwards are recomputed, each holds
+        until the next newer takeover and the newest until now. Assists (stored with hold_time 0) are kept as
+        they are. Returns None if all takeovers were already there.
+        """
+        new_df = pd.DataFrame({'user_name': [takeover.user.name for takeover, _ in visits],
+                               'points': [takeover.zone.takeover_points or 0 for takeover, _ in visits],
+                               'hold_time': 0,
+                               'visit_date': pd.to_datetime([visit_date for _, visit_date in visits]),
+                               'is_takeover': True})
+        visits_df = visits_df.copy()
+        visits_df['visit_date'] = pd.to_datetime(visits_df['visit_date'])
+        visits_df['is_takeover'] = visits_df['hold_time'] > 0
+
+        # Visits already in the store win over the ones from the feed
+        df = pd.concat([new_df, visits_df], ignore_index=True)
+        df = df.drop_duplicates(['user_name', 'visit_date'], keep='last')
+        if len(df) == len(visits_df):
+            return None
+        df = df.sort_values('visit_date', ascending=False, kind='mergesort').reset_index(drop=True)
+
+        takeovers = df[df['is_takeover'] & (df['user_name'] != 'neutral')]
+        dates = takeovers['visit_date']
+        first_new = new_df['visit_date'].min()
+        earlier = dates[dates < first_new]
+        start = earlier.max() if len(earlier) else first_new
+        held_until = dates.shift(1).fillna(pd.Timestamp(now))
+        recompute = dates >= start
+        df.loc[recompute[recompute].index, 'hold_time'] = \
+            (held_until - dates)[recompute].dt.total_seconds().clip(lower=0).astype('int64')
+        df['hold_time'] = df['hold_time'].astype('int64')
+        return df.drop(columns='is_takeover')
+
+if __name__ == "__main__":
+    # Usage: python feedingester.py
+    # Runs until interrupted, the cursor is kept in takeovers.db so it can be restarted at any time
+    ingester = TakeoverFeedIngester(store=TakeoverStore(), zone_cache=ZoneCache(), visit_store=VisitStore())
+    try:
+        ingester.run()
+    except KeyboardInterrupt:
+        print(f"Stopped, {len(ingester.store)} takeovers stored.")
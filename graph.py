@@ -1,118 +1,509 @@
 from datetime import datetime
+import heapq
 from typing import List
 
+import numpy as np
+
 from graphhopperapi import GraphHopperAPI
+from spatialindex import SpatialIndex
 from turfclasses import Zone
-from util import sl_distance
+from util import coordinate_arrays, sl_distances
 
 
 class Edge:
-    def __init__(self, start, finish, cost: float, route=None):
+    """
+    Edge between two nodes. Edges in a graph are views of the graph's CSR arrays, edges created
+    directly are detached until they are added to a node in a graph with Node.add_edge.
+    Views are invalidated when edges are added to or removed from the graph.
+    """
+    def __init__(self, start, finish, cost: float, route=None, route_loader=None, distance: float=None):
         self.start = start
         self.finish = finish
-        self.cost = cost
-        self.route = route
+        self.graph = None
+        self.position = None     # Position in the graph's CSR arrays
+
+        self._cost = cost
+        self._distance = distance    # Route distance in meters
+        # Full route geometry is only fetched when it is needed, using route_loader(start, finish)
+        self._route = route
+        self.route_loader = route_loader
+
+    @classmethod
+    def view(cls, graph, position: int):
+        edge = cls.__new__(cls)
+        edge.graph = graph
+        edge.position = position
+        edge.start = graph.nodes[graph.sources[position]]
+        edge.finish = graph.nodes[graph.targets[position]]
+        # Route geometry as loaded when the view was made (without loading it), so views can be added like detached edges
+        route_id = graph.route_ids[position]
+        edge._route = graph.routes[route_id] if route_id >= 0 else None
+        edge.route_loader = graph.route_loader
+        return edge
+
+    @property
+    def cost(self):
+        if self.graph is None:
+            return self._cost
+        return float(self.graph.costs[self.position])
+
+    @cost.setter
+    def cost(self, cost: float):
+        if self.graph is None:
+            self._cost = cost
+        else:
+            self.graph.costs[self.position] = cost
+            self.graph.version += 1
+
+    @property
+    def distance(self):
+        if self.graph is None:
+            return self._distance
+        distance = self.graph.distances[self.position]
+        return None if np.isnan(distance) else float(distance)
+
+    @property
+    def route(self):
+        if self.graph is None:
+            if self._route is None and self.route_loader is not None:
+                route = self.route_loader(self.start.zone.coordinate, self.finish.zone.coordinate)
+                if not route:
+                    return None     # Failed fetches are not kept, so the route is fetched again next time
+                self._route = route
+            return self._route
+        return self.graph.get_route(self.position)
+
+    @route.setter
+    def route(self, route):
+        if self.graph is None:
+            self._route = route
+        else:
+            self.graph.set_route(self.position, route)
 
 
 class Node:
+    """Zone in a graph. Once added to a graph, the node's edges are read from the graph's CSR arrays."""
     def __init__(self, zone: Zone):
         self.zone = zone
-        self.edges = []
+        self.graph = None
+        self.index = None   # Position in graph.nodes, set by Graph.add_node
+        self._edges = []    # Edges added before the node is part of a graph
 
-        # For search algorithms
-        self.cost = 0
-        self.visited = False
-        self.previous = None
-        self.next = None
+    @property
+    def edges(self):
+        if self.graph is None:
+            return self._edges
+        start, end = self.graph.edge_range(self.index)
+        return [Edge.view(self.graph, position) for position in range(start, end)] + self._edges
 
     def add_edge(self, edge: Edge):
         assert type(edge) == Edge, f"{edge} ({type(edge)}) is not of type Edge!"
-        self.edges.append(edge)
+        if self.graph is None or edge.finish.graph is not self.graph:
+            self._edges.append(edge)
+            if self.graph is not None:
+                self.graph._detached.add(self)
+        else:
+            self.graph.add_edges([self.index], [edge.finish.index], [edge.cost], [edge.distance],
+                                 [edge._route], edge.route_loader)
 
     def remove_edge(self, edge: Edge):
-        self.edges.remove(edge)
+        if edge.graph is None:
+            self._edges.remove(edge)
+        else:
+            self.graph.remove_edges([edge.position])
 
     def __str__(self):
         return f"Node: {self.zone.name}"
 
 
 class Graph:
+    """
+    Graph with node attributes in NumPy arrays and edges in CSR form: the edges of node i are at
+    positions offsets[i]:offsets[i + 1] in sources, targets, costs, distances and route_ids.
+    Route geometry is kept in routes (as Route objects with encoded polylines) and referenced by route_ids
+    (-1 if not loaded yet).
+    """
     def __init__(self, graph_connectedness: float=4):
         self.graph_connectedness = graph_connectedness
         self.nodes = []
+        self.route_loader = None    # route_loader(start, finish) for routes that are not loaded
+        self.version = 0            # Incremented on every change, used to invalidate caches
+
+        # Node attributes
+        self.lats = np.zeros(0)
+        self.lons = np.zeros(0)
+        self.values = np.zeros(0)   # Zone values used for edge costs, nan if unknown
+
+        # Edges in CSR form
+        self.offsets = np.zeros(1, dtype=np.intp)
+        self.sources = np.zeros(0, dtype=np.intp)
+        self.targets = np.zeros(0, dtype=np.intp)
+        self.costs = np.zeros(0)
+        self.distances = np.zeros(0)
+        self.route_ids = np.zeros(0, dtype=np.intp)
+        self.routes = []
+
+        self._names = {}
+        self._adjacency = None
+        self._detached = set()  # Nodes with edges to nodes that are not in the graph yet
+        self._spatial_index = None
+
+        # Used to add edges when zone values change, set by build_graph
+        self.gh_api = None
+        self.use_matrix = True
 
     def add_node(self, node: Node):
         assert type(node) == Node, f"{node} ({type(node)}) is not of type Node!"
+        node.graph = self
+        node.index = len(self.nodes)
         self.nodes.append(node)
+        self._names.setdefault(node.zone.name, node)
+
+        self.lats = np.append(self.lats, node.zone.coordinate.lat)
+        self.lons = np.append(self.lons, node.zone.coordinate.lon)
+        self.values = np.append(self.values, np.nan)
+        self.offsets = np.append(self.offsets, self.offsets[-1])
+        self.version += 1
+
+        if node._edges:
+            self._detached.add(node)
+        self._attach_detached_edges()
+
+    def add_nodes(self, nodes: List[Node]):
+        """Add many nodes at once, without growing the node arrays one by one"""
+        for node in nodes:
+            assert type(node) == Node, f"{node} ({type(node)}) is not of type Node!"
+            node.graph = self
+            node.index = len(self.nodes)
+            self.nodes.append(node)
+            self._names.setdefault(node.zone.name, node)
+
+        lats, lons = coordinate_arrays([node.zone.coordinate for node in nodes])
+        self.lats = np.concatenate((self.lats, lats))
+        self.lons = np.concatenate((self.lons, lons))
+        self.values = np.concatenate((self.values, np.full(len(nodes), np.nan)))
+        self.offsets = np.concatenate((self.offsets, np.full(len(nodes), self.offsets[-1])))
+        self.version += 1
+
+        self._detached.update(node for node in nodes if node._edges)
+        self._attach_detached_edges()
+
+    def _attach_detached_edges(self):
+        """Move edges added while their nodes were detached into the graph, once both ends are in it"""
+        for node in list(self._detached):
+            attach = [edge for edge in node._edges if edge.finish.graph is self]
+            node._edges = [edge for edge in node._edges if edge.finish.graph is not self]
+            if not node._edges:
+                self._detached.discard(node)
+            for edge in attach:
+                node.add_edge(edge)
 
     def get_node_by_name(self, name: str):
-        for node in self.nodes:
-            if node.zone.name == name:
-                return node
-        return None
-
-
-def build_graph(zones: List[Zone], date: datetime):
-    graph = Graph()
-    gh_api = GraphHopperAPI()
-
-    for zone in zones:
-        node = Node(zone)
-        graph.add_node(node)
-
-    for node in graph.nodes:
-        # print('Adding edges for', node.zone.name)
-        for other_node in graph.nodes:
-            if node is other_node:
-                continue
-
-            # Filter out unreasonable connections to create a sparse graph
-            if sl_distance(node.zone.coordinate, other_node.zone.coordinate) > graph.graph_connectedness * other_node.zone.value(date): # dist / value > graph_connectedness
+        return self._names.get(name)
+
+    @property
+    def num_edges(self):
+        return len(self.targets)
+
+    def edge_range(self, index: int):
+        """Start and end positions of the edges of node index in the CSR arrays"""
+        return int(self.offsets[index]), int(self.offsets[index + 1])
+
+    def add_edges(self, starts, finishes, costs, distances=None, routes=None, route_loader=None):
+        """Add edges in bulk, keeping the edges of each node in insertion order"""
+        starts = np.asarray(starts, dtype=np.intp)
+        if len(starts) == 0:
+            return
+        finishes = np.asarray(finishes, dtype=np.intp)
+        costs = np.asarray(costs, dtype=np.float64)
+        if distances is None:
+            distances = np.full(len(starts), np.nan)
+        distances = np.array([np.nan if d is None else d for d in distances], dtype=np.float64)
+
+        route_ids = np.full(len(starts), -1, dtype=np.intp)
+        if routes is not None:
+            for k, route in enumerate(routes):
+                if route is not None:
+                    route_ids[k] = len(self.routes)
+                    self.routes.append(route)
+        if route_loader is not None:
+            self.route_loader = route_loader
+
+        all_starts = np.concatenate((self.sources, starts))
+        order = np.argsort(all_starts, kind='stable')
+        self.sources = all_starts[order]
+        self.targets = np.concatenate((self.targets, finishes))[order]
+        self.costs = np.concatenate((self.costs, costs))[order]
+        self.distances = np.concatenate((self.distances, distances))[order]
+        self.route_ids = np.concatenate((self.route_ids, route_ids))[order]
+        self._update_offsets()
+
+    def remove_edges(self, positions):
+        """Remove the edges at the given positions in the CSR arrays"""
+        if len(positions) == 0:
+            return
+        keep = np.ones(self.num_edges, dtype=bool)
+        keep[np.asarray(positions, dtype=np.intp)] = False
+        self.sources = self.sources[keep]
+        self.targets = self.targets[keep]
+        self.costs = self.costs[keep]
+        self.distances = self.distances[keep]
+        self.route_ids = self.route_ids[keep]
+        self._update_offsets()
+
+    def _update_offsets(self):
+        counts = np.bincount(self.sources, minlength=len(self.nodes))
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.intp)
+        self.version += 1
+
+    def get_spatial_index(self):
+        """Spatial index over the node coordinates, cached until nodes are added"""
+        if self._spatial_index is None or len(self._spatial_index) != len(self.nodes):
+            self._spatial_index = SpatialIndex([node.zone.coordinate for node in self.nodes])
+        return self._spatial_index
+
+    def candidate_edges(self, finishes=None):
+        """
+        Edges (starts, finishes) that pass the pruning filter, for all nodes or only into the given finishes.
+        An edge into a node is only considered if dist / value(node) <= graph_connectedness,
+        so each node only needs to look for starting nodes within its own radius.
+        Nodes whose value is unknown (nan) get no edges in. The original pairwise loop connected every
+        node to them, with a nan cost that searches can't use, and update_zone_values removes such edges too.
+        """
+        if finishes is None:
+            finishes = np.arange(len(self.nodes))
+        finishes = np.asarray(finishes, dtype=np.intp)
+        radii = self.graph_connectedness * self.values
+
+        all_starts = []
+        all_finishes = []
+        for j, neighbours in zip(finishes, self.get_spatial_index().query_radii(radii[finishes], finishes)):
+            for i in neighbours:
+                if i != j:
+                    all_starts.append(i)
+                    all_finishes.append(j)
+        starts = np.array(all_starts, dtype=np.intp)
+        finishes = np.array(all_finishes, dtype=np.intp)
+
+        # The index only returns candidates, the exact distance decides
+        distances = sl_distances(self.lats[starts], self.lons[starts], self.lats[finishes], self.lons[finishes])
+        keep = distances <= radii[finishes]
+        starts, finishes = starts[keep], finishes[keep]
+        order = np.lexsort((finishes, starts))
+
+        return starts[order], finishes[order]
+
+    def connect(self, starts, finishes):
+        """Fetch route distances for the given node pairs from gh_api and add them as edges"""
+        pairs = [(self.nodes[i].zone.coordinate, self.nodes[j].zone.coordinate) for i, j in zip(starts, finishes)]
+        if self.use_matrix:
+            bike_routes = self.gh_api.get_bike_distances(pairs)
+        else:
+            bike_routes = self.gh_api.get_bike_routes(pairs)
+
+        found = []
+        for k, (i, j, bike_route) in enumerate(zip(starts, finishes, bike_routes)):
+            if not bike_route:
+                print(f"No route from {self.nodes[i].zone.name} to {self.nodes[j].zone.name}, skipping edge.")
                 continue
+            found.append(k)
+
+        starts, finishes = np.asarray(starts, dtype=np.intp)[found], np.asarray(finishes, dtype=np.intp)[found]
+        route_distances = np.array([bike_routes[k]['distance'] for k in found], dtype=np.float64)
+        edge_costs = route_distances / self.values[finishes]
+
+        if self.use_matrix:
+            self.add_edges(starts, finishes, edge_costs, route_distances, route_loader=self.gh_api.get_bike_route)
+        else:
+            self.add_edges(starts, finishes, edge_costs, route_distances, [bike_routes[k] for k in found],
+                           route_loader=self.gh_api.get_bike_route)
+
+    def reweight(self, date: datetime):
+        """Recompute zone values for date and update the edges, see update_zone_values"""
+        self.update_zone_values([node.zone.value(date) for node in self.nodes])
+
+    def update_zone_values(self, values):
+        """
+        Set new zone values and update the graph in place. Costs of edges into changed zones are recomputed
+        from the stored route distances, edges that are now outside the pruning radius are removed, and
+        edges that are now inside it are added. Only edges into zones whose value changed are touched.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        old_values = self.values
+        changed = np.flatnonzero(~((values == old_values) | (np.isnan(values) & np.isnan(old_values))))
+        if len(changed) == 0:
+            return
+        self.values = values.copy()
+
+        # Recompute costs of edges into changed zones
+        affected = np.flatnonzero(np.isin(self.targets, changed))
+        self.costs[affected] = self.distances[affected] / self.values[self.targets[affected]]
+        version = self.version
+
+        # Remove edges that no longer pass the filter
+        radii = self.graph_connectedness * self.values
+        shrunk = changed[~(values[changed] >= old_values[changed])]
+        if len(shrunk):
+            positions = np.flatnonzero(np.isin(self.targets, shrunk))
+            distances = sl_distances(self.lats[self.sources[positions]], self.lons[self.sources[positions]],
+                                     self.lats[self.targets[positions]], self.lons[self.targets[positions]])
+            self.remove_edges(positions[~(distances <= radii[self.targets[positions]])])
+
+        # Add edges that pass the filter now but did not before
+        grown = changed[~(values[changed] <= old_values[changed])]
+        if len(grown):
+            starts, finishes = self.candidate_edges(grown)
+            into = np.flatnonzero(np.isin(self.targets, grown))
+            existing = set(zip(self.sources[into].tolist(), self.targets[into].tolist()))
+            new = [k for k, pair in enumerate(zip(starts.tolist(), finishes.tolist())) if pair not in existing]
+            self.connect(starts[new], finishes[new])
+
+        if self.version == version:
+            self._patch_adjacency(affected)
+        else:
+            self.version += 1
+
+    def set_edge_costs(self, positions, costs):
+        """Set the costs of the edges at the given positions in the CSR arrays"""
+        positions = np.asarray(positions, dtype=np.intp)
+        self.costs[positions] = costs
+        self._patch_adjacency(positions)
+
+    def _patch_adjacency(self, positions):
+        """Bump the version after edge costs changed, updating the cached adjacency lists instead of rebuilding them"""
+        cached = self._adjacency is not None and self._adjacency[0] == self.version
+        self.version += 1
+        if cached:
+            edge_costs = self._adjacency[3]
+            for position, cost in zip(positions.tolist(), self.costs[positions].tolist()):
+                edge_costs[position] = cost
+            self._adjacency = (self.version,) + self._adjacency[1:]
+
+    def get_route(self, position: int):
+        """Route geometry of the edge at position, loaded with route_loader if needed"""
+        route_id = self.route_ids[position]
+        if route_id < 0:
+            if self.route_loader is None:
+                return None
+            start = self.nodes[self.sources[position]].zone.coordinate
+            finish = self.nodes[self.targets[position]].zone.coordinate
+            route = self.route_loader(start, finish)
+            if not route:
+                return None     # Failed fetches are not kept, so the route is fetched again next time
+            return self.set_route(position, route)
+        return self.routes[route_id]
+
+    def set_route(self, position: int, route):
+        self.route_ids[position] = len(self.routes)
+        self.routes.append(route)
+        return route
+
+    def adjacency(self):
+        """Offsets, targets and costs as Python lists, cached until the graph changes. Fast to iterate in searches."""
+        if self._adjacency is None or self._adjacency[0] != self.version:
+            self._adjacency = (self.version, self.offsets.tolist(), self.targets.tolist(), self.costs.tolist())
+        return self._adjacency[1:]
+
+
+def build_graph(zones: List[Zone], date: datetime, gh_api: GraphHopperAPI=None, use_matrix: bool=True):
+    """
+    Build a sparse graph between zones. With use_matrix, only distances are fetched (using the
+    GraphHopper matrix API) and the route geometry of an edge is fetched when it is first accessed.
+    """
+    graph = Graph()
+    graph.gh_api = gh_api if gh_api is not None else GraphHopperAPI()
+    graph.use_matrix = use_matrix
 
-            bike_route = gh_api.get_bike_route(node.zone.coordinate, other_node.zone.coordinate)
-            edge_cost = bike_route['distance'] / other_node.zone.value(date)
+    graph.add_nodes([Node(zone) for zone in zones])
+    graph.values = np.array([node.zone.value(date) for node in graph.nodes], dtype=np.float64)
 
-            edge = Edge(node, other_node, edge_cost, bike_route)
-            node.add_edge(edge)
+    starts, finishes = graph.candidate_edges()
+    graph.connect(starts, finishes)
 
     return graph
 
 
 def dijkstra_search(graph: Graph, start: Node, finish: Node):
+    """Find the cheapest path from start to finish, returns a list of nodes (empty if unreachable)"""
     print('Performing search from', start.zone.name, 'to', finish.zone.name)
-
-    for node in graph.nodes:
-        node.visited = False
-        node.cost = float('inf')
-        node.previous = None
-
-    start.cost = 0
-    current = start
-
-    while current != finish:
-        # print(current.zone.name)
-        for edge in current.edges:
-            if edge.finish.cost > current.cost + edge.cost:
-                edge.finish.cost = current.cost + edge.cost
-                edge.finish.previous = current
-
-        current.visited = True
-
-        min_cost = float('inf')
-        for node in graph.nodes:
-            if not node.visited and node.cost < min_cost:
-                min_cost = node.cost
-                current = node
+    path, _ = _heap_search(graph, start, finish, heuristic=None)
+    return path
+
+
+def astar_search(graph: Graph, start: Node, finish: Node):
+    """
+    Find the cheapest path from start to finish using A*, returns a list of nodes (empty if unreachable).
+    The heuristic is the straight line distance to finish divided by the highest zone value in the graph.
+    It never overestimates since every edge costs at least its straight line distance divided by that value.
+    """
+    print('Performing A* search from', start.zone.name, 'to', finish.zone.name)
+    path, _ = _heap_search(graph, start, finish, heuristic=straight_line_heuristic(graph, finish))
+    return path
+
+
+def max_zone_value(graph: Graph):
+    """Highest zone value among nodes with incoming edges"""
+    if graph.num_edges == 0:
+        return 0
+    values = graph.values[graph.targets]
+    if np.isnan(values).any():
+        # Fall back to values derived from edge distances and costs
+        if np.isnan(graph.distances).any() or (graph.costs <= 0).any():
+            return float('inf')
+        values = graph.distances / graph.costs
+    return float(values.max())
+
+
+def straight_line_heuristic(graph: Graph, finish: Node):
+    """Array of admissible cost estimates from every node to finish"""
+    max_value = max_zone_value(graph)
+    if not graph.nodes or max_value == 0 or max_value == float('inf'):
+        return np.zeros(len(graph.nodes))
+
+    return sl_distances(graph.lats, graph.lons, graph.lats[finish.index], graph.lons[finish.index]) / max_value
+
+
+def _heap_search(graph: Graph, start: Node, finish: Node, heuristic=None):
+    """
+    Dijkstra/A* search with a binary heap over the graph's CSR arrays. All search state is kept in
+    local lists, so several searches can run on the same graph at the same time.
+    Returns (path, cost), where path is empty and cost is inf if finish can't be reached.
+    """
+    offsets, targets, edge_costs = graph.adjacency()
+    if heuristic is not None:
+        heuristic = heuristic.tolist()
+
+    costs = [float('inf')] * len(graph.nodes)
+    previous = [None] * len(graph.nodes)
+    visited = [False] * len(graph.nodes)
+
+    costs[start.index] = 0
+    queue = [(0 if heuristic is None else heuristic[start.index], start.index)]
+
+    while queue:
+        _, current = heapq.heappop(queue)
+        if visited[current]:
+            continue
+        visited[current] = True
+        if current == finish.index:
+            break
+
+        for position in range(offsets[current], offsets[current + 1]):
+            other = targets[position]
+            cost = costs[current] + edge_costs[position]
+            if cost < costs[other]:
+                costs[other] = cost
+                previous[other] = current
+                priority = cost if heuristic is None else cost + heuristic[other]
+                heapq.heappush(queue, (priority, other))
+
+    if not visited[finish.index]:
+        return [], float('inf')
 
     path = []
+    current = finish.index
     while current is not None:
-        path.append(current)
-        prev = current.previous
-        if prev:
-            prev.next = current
-        current = prev
-
-    return path[::-1]
-
+        path.append(graph.nodes[current])
+        current = previous[current]
 
+    return path[::-1], costs[finish.index]
@@ -1,7 +1,10 @@
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import polyline
 import os
+import threading
+from typing import List, Tuple
 
 from turfclasses import Coordinate, User, Region, Zone
 from apikeys import GRAPHHOPPER_API_KEY
@@ -9,37 +12,273 @@ from apikeys import GRAPHHOPPER_API_KEY
 import json
 import folium
 
-from util import load_from_json, save_to_json
+from ratelimit import QuotaExceededError, RateLimiter
+from routestore import RouteStore
+
+class Route:
+    """
+    Bike route from GraphHopper. The geometry is kept as encoded polylines, a few bytes per point instead
+    of a list of float pairs, and decoded each time points or snapped_waypoints is read.
+    Values can also be read as route['distance'], route['points'] etc. like the route dicts it replaces.
+    """
+    PRECISION = 5   # Decimals used by GraphHopper's encoding
+    __slots__ = ('distance', 'time', 'ascend', 'descend', 'encoded_points', 'encoded_snapped_waypoints')
+
+    def __init__(self, distance: float, time: float, ascend: float=None, descend: float=None,
+                 encoded_points: str='', encoded_snapped_waypoints: str=''):
+        self.distance = distance
+        self.time = time    # Milliseconds
+        self.ascend = ascend
+        self.descend = descend
+        self.encoded_points = encoded_points
+        self.encoded_snapped_waypoints = encoded_snapped_waypoints
+
+    @property
+    def points(self):
+        """Route geometry as (lat, lon) pairs"""
+        return polyline.decode(self.encoded_points, self.PRECISION)
+
+    @property
+    def snapped_waypoints(self):
+        return polyline.decode(self.encoded_snapped_waypoints, self.PRECISION)
+
+    def __getitem__(self, key: str):
+        if key not in ('distance', 'time', 'ascend', 'descend', 'points', 'snapped_waypoints'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def to_dict(self):
+        """As stored in the route store, with the geometry encoded like in GraphHopper responses"""
+        return {'distance': self.distance, 'time': self.time, 'ascend': self.ascend, 'descend': self.descend,
+                'points_encoded': True, 'points': self.encoded_points, 'snapped_waypoints': self.encoded_snapped_waypoints}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Route from a stored dict. Routes stored before the geometry was kept encoded have decoded point lists."""
+        points, snapped_waypoints = data['points'], data['snapped_waypoints']
+        if not data.get('points_encoded'):
+            points = polyline.encode(points, cls.PRECISION)
+            snapped_waypoints = polyline.encode(snapped_waypoints, cls.PRECISION)
+        return cls(data['distance'], data['time'], data.get('ascend'), data.get('descend'), points, snapped_waypoints)
+
 
 class GraphHopperAPI:
     BASE_URL = "https://graphhopper.com/api/1/"
     TURF_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+    MATRIX_MAX_FROM_POINTS = 40     # Keep from + to within the API limit of locations per matrix request
+    MATRIX_MAX_TO_POINTS = 40
 
-    def __init__(self):
-        pass
+    # Rate limiters are shared between all instances using the same API key
+    _rate_limiters = {}
+    _rate_limiters_lock = threading.Lock()
 
-    def get_bike_route(self, start: Coordinate, finish: Coordinate):
-        """Fetch zones in an area from the Turf API based on north-east and south-west coordinates"""
-        filename = f'routes/{start.lat:.4f}_{start.lon:.4f}_to_{finish.lat:.4f}_{finish.lon:.4f}.json'
+    def __init__(self, api_key: str=GRAPHHOPPER_API_KEY, base_url: str=BASE_URL,
+                 requests_per_second: float=None, quota: int=None, max_workers: int=8,
+                 route_store: RouteStore=None, timeout: float=30):
+        """
+        requests_per_second and quota limit the requests made with api_key, across all instances.
+        max_workers is the size of the thread pool used by get_bike_routes.
+        timeout is in seconds per request, a request that fails or times out counts as no route.
+        route_store defaults to routes.db, with the old routes/*.json files migrated into it.
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.timeout = timeout
 
+        if route_store is None:
+            route_store = RouteStore('routes.db')
+            route_store.migrate_json_dir('routes')
+        self.route_store = route_store
+
+        with self._rate_limiters_lock:
+            if api_key not in self._rate_limiters:
+                self._rate_limiters[api_key] = RateLimiter(requests_per_second, quota)
+            self.rate_limiter = self._rate_limiters[api_key]
+            if requests_per_second is not None:
+                self.rate_limiter.requests_per_second = requests_per_second
+            if quota is not None:
+                self.rate_limiter.quota = quota
+
+    def get_bike_route(self, start: Coordinate, finish: Coordinate):
+        """Fetch a bike route between two coordinates from GraphHopper, or from cache if available"""
         # Check for cached data
-        if os.path.exists(filename):
-            print(f"{filename} already exists. Loading from file.")
-            return load_from_json(filename)
+        route = self.route_store.get(start, finish)
+        if route is not None:
+            return Route.from_dict(route)
 
         # If not cached, fetch from GraphHopper
-        print(f"{filename} not found. Fetching from GraphHopper.")
-        url = f"{self.BASE_URL}route?key=" + GRAPHHOPPER_API_KEY
+        print(f"Route from {start} to {finish} not cached. Fetching from GraphHopper.")
+        return self._fetch_bike_route(start, finish)
+
+
+    def get_bike_routes(self, pairs: List[Tuple[Coordinate, Coordinate]]):
+        """
+        Fetch bike routes for a list of (start, finish) pairs. Cached routes are loaded directly,
+        the rest are fetched concurrently using a pool of max_workers threads.
+        Returns a list of routes in the same order as pairs.
+        """
+        routes = [Route.from_dict(route) if route is not None else None for route in self.route_store.get_many(pairs)]
+        uncached = [i for i, route in enumerate(routes) if route is None]
+
+        print(f"{len(pairs) - len(uncached)} routes loaded from cache, fetching {len(uncached)} from GraphHopper.")
+        if not uncached:
+            return routes
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._fetch_bike_route, *pairs[i]): i for i in uncached}
+            for future in as_completed(futures):
+                routes[futures[future]] = future.result()
+
+        return routes
+
+
+    def get_bike_distances(self, pairs: List[Tuple[Coordinate, Coordinate]]):
+        """
+        Get distance and time for a list of (start, finish) pairs without fetching full route geometry.
+        Cached routes and summaries are used where available, the rest are fetched with as few
+        matrix requests as possible. Returns a list of {'distance', 'time'} dicts (empty on failure)
+        in the same order as pairs.
+        """
+        summaries = self.route_store.get_many(pairs, kind='summary')
+        missing = [i for i, summary in enumerate(summaries) if summary is None]
+        for i, route in zip(missing, self.route_store.get_many([pairs[i] for i in missing])):
+            if route is not None:
+                summaries[i] = {'distance': route['distance'], 'time': route['time']}
+        uncached = [i for i, summary in enumerate(summaries) if summary is None]
+
+        print(f"{len(pairs) - len(uncached)} distances loaded from cache, fetching {len(uncached)} from GraphHopper matrix.")
+        if not uncached:
+            return summaries
+
+        # Group the missing pairs by start point, identical coordinates share a matrix row/column
+        starts = {}
+        coordinates = {}
+        for i in uncached:
+            start, finish = pairs[i]
+            start_key, finish_key = self._coordinate_key(start), self._coordinate_key(finish)
+            starts.setdefault(start_key, {}).setdefault(finish_key, []).append(i)
+            coordinates.setdefault(start_key, start)
+            coordinates.setdefault(finish_key, finish)
+
+        chunks = self._matrix_chunks(starts)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(lambda chunk: self._fetch_matrix([coordinates[key] for key in chunk[0]],
+                                                                    [coordinates[key] for key in chunk[1]]), chunks)
+            for (chunk_starts, chunk_finishes), matrix in zip(chunks, results):
+                if matrix is None:
+                    continue
+                new_summaries = []
+                for row, start in enumerate(chunk_starts):
+                    for col, finish in enumerate(chunk_finishes):
+                        indices = starts[start].get(finish)
+                        if indices is None or matrix['distances'][row][col] is None:
+                            continue
+                        # Matrix times are in seconds, route times in milliseconds
+                        summary = {'distance': matrix['distances'][row][col],
+                                   'time': matrix['times'][row][col] * 1000}
+                        for i in indices:
+                            summaries[i] = summary
+                        new_summaries.append((*pairs[indices[0]], summary))
+                self.route_store.put_many(new_summaries, kind='summary')
+
+        return [summary if summary is not None else {} for summary in summaries]
+
+
+    def _fetch_matrix(self, starts: List[Coordinate], finishes: List[Coordinate]):
+        """Fetch a distance/time matrix from GraphHopper, returns None on failure"""
+        try:
+            self.rate_limiter.acquire()
+        except QuotaExceededError as e:
+            print(f"Error getting matrix: {e}")
+            return None
+
+        url = f"{self.base_url}matrix?key=" + self.api_key
+        payload = {
+            "from_points": [[start.lon, start.lat] for start in starts],    # NOTE: Inverted order of lat/lon
+            "to_points": [[finish.lon, finish.lat] for finish in finishes],
+            "profile": "bike",
+            "out_arrays": ["distances", "times"]
+        }
+        try:
+            response = requests.post(url, json=payload, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"Error getting matrix: {e}")
+            return None
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            print(f"Error getting matrix: {response.status_code}")
+            return None
+
+
+    def _matrix_chunks(self, starts: dict):
+        """
+        Split {start key: {finish key: ...}} into (start keys, finish keys) matrix requests. Every cell of a
+        matrix is paid for, so starts are taken in Z-order (nearby starts share most of their finishes) and
+        a chunk is closed when the next start would bring in more finishes than fit in one request.
+        """
+        chunks = []
+        chunk_starts = []
+        chunk_finishes = {}
+
+        def close_chunk():
+            finishes = list(chunk_finishes)
+            for l in range(0, len(finishes), self.MATRIX_MAX_TO_POINTS):
+                chunks.append((chunk_starts, finishes[l:l + self.MATRIX_MAX_TO_POINTS]))
+
+        for start in sorted(starts, key=self._z_order):
+            new_finishes = [finish for finish in starts[start] if finish not in chunk_finishes]
+            if chunk_starts and (len(chunk_starts) >= self.MATRIX_MAX_FROM_POINTS or
+                                 len(chunk_finishes) + len(new_finishes) > self.MATRIX_MAX_TO_POINTS):
+                close_chunk()
+                chunk_starts, chunk_finishes = [], {}
+                new_finishes = list(starts[start])
+            chunk_starts.append(start)
+            chunk_finishes.update(dict.fromkeys(new_finishes))
+        if chunk_starts:
+            close_chunk()
+        return chunks
+
+    @staticmethod
+    def _z_order(key):
+        """Position of a quantized (lat, lon) key along a Z-order curve, nearby keys get nearby positions"""
+        lat, lon = key[0] + 900000, key[1] + 1800000    # Non-negative, keys have 4 decimals
+        position = 0
+        for bit in range(22):
+            position |= ((lat >> bit) & 1) << (2 * bit + 1) | ((lon >> bit) & 1) << (2 * bit)
+        return position
+
+    def _coordinate_key(self, coordinate: Coordinate):
+        """Coordinates are quantized the same way as in the route store"""
+        return self.route_store.quantize(coordinate)
+
+
+    def _fetch_bike_route(self, start: Coordinate, finish: Coordinate):
+        """Fetch a bike route from GraphHopper and cache it, returns an empty dict on failure"""
+        try:
+            self.rate_limiter.acquire()
+        except QuotaExceededError as e:
+            print(f"Error getting route: {e}")
+            return {}
+
+        url = f"{self.base_url}route?key=" + self.api_key
         payload = {
             "points": [[start.lon, start.lat], [finish.lon, finish.lat]],   # NOTE: Inverted order of lat/lon
             "profile": "bike",
             "points_encoded": True
         }
-        response = requests.post(url, json=payload)
+        try:
+            response = requests.post(url, json=payload, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"Error getting route: {e}")
+            return {}
 
         if response.status_code == 200:
             route = self._parse_route(response.json())
-            save_to_json(route, filename)
+            self.route_store.put(start, finish, route.to_dict())
             return route
         else:
             print(f"Error getting route: {response.status_code}")
@@ -47,22 +286,17 @@ class GraphHopperAPI:
 
 
     def _parse_route(self, data):
-        """Helper method to convert API data into Route object"""
+        """Helper method to convert API data into Route object, the geometry is kept encoded"""
         path = data['paths'][0]
-        route = {}
-        route['distance'] = path['distance']
-        route['time'] = path['time']
-        route['ascend'] = path['ascend']
-        route['descend'] = path['descend']
-
         if path['points_encoded']:
-            route['points'] = polyline.decode(path['points'], 5)
-            route['snapped_waypoints'] = polyline.decode(path['snapped_waypoints'], 5)
+            points = path['points']
+            snapped_waypoints = path['snapped_waypoints']
         else:
-            route['points'] = [[point[1], point[0]] for point in path['points']['coordinates']]
-            route['snapped_waypoints'] = [[point[1], point[0]] for point in path['snapped_waypoints']['coordinates']]
+            points = polyline.encode([(point[1], point[0]) for point in path['points']['coordinates']], Route.PRECISION)
+            snapped_waypoints = polyline.encode([(point[1], point[0]) for point in path['snapped_waypoints']['coordinates']],
+                                                Route.PRECISION)
 
-        return route
+        return Route(path['distance'], path['time'], path['ascend'], path['descend'], points, snapped_waypoints)
 
 
 
@@ -1,4 +1,8 @@
+import copy
 from datetime import datetime
+import itertools
+import json
+import os
 import folium
 import folium.plugins as plugins
 from typing import List
@@ -6,6 +10,7 @@ from typing import List
 from turfclasses import Zone
 from area import Area
 from graph import Graph
+from maplayers import EdgeLayer, LiveData, PathLayer, ZoneLayer, write_if_changed, zone_features, zone_state
 
 
 class GUI:
@@ -26,9 +31,23 @@ class GUI:
 
 
 class FoliumGUI(GUI):
-    def __init__(self, center, zoom_start=14):
+    def __init__(self, center, zoom_start=14, geojson=False, current_user='l355', live=False, live_interval=30):
+        """
+        With geojson, layers are drawn from GeoJSON data in the browser instead of as one Leaflet object
+        with its own HTML per zone, which keeps the map small and fast for thousands of zones.
+        With live (implies geojson), save_map writes the page as a shell that loads zones, edges and path from
+        JSON files next to it, checking for changes every live_interval seconds. Saving again only rewrites
+        the files that changed. The page has to be served over HTTP, e.g. with python -m http.server.
+        """
         super().__init__(center)
         self.map = folium.Map(location=(center.lat, center.lon), zoom_start=zoom_start)
+        self.geojson = geojson or live
+        self.current_user = current_user
+        self.data_layers = {}
+        self.layer_control = None
+
+        # Added first, the layers' scripts use it
+        self.live_data = LiveData(None, live_interval).add_to(self.map) if live else None
 
 
     def draw_bbox(self, ne, sw):
@@ -43,12 +62,16 @@ class FoliumGUI(GUI):
 
 
     def draw_zones(self, zones, date=datetime.now()):
+        if self.geojson:
+            self.data_layers['zones'] = ZoneLayer(zone_features(zones), zone_state(zones, date, self.current_user)).add_to(self.map)
+            return
+
         marker_group = folium.FeatureGroup(name='Zone Markers', show=True).add_to(self.map)
         nametag_group = folium.FeatureGroup(name='Zone Names', show=True).add_to(self.map)
 
         for zone in zones:
             zone_icon = str(zone.points_per_hour)
-            if zone.current_owner.name == 'l355':   # TODO: Implement properly!
+            if zone.current_owner.name == self.current_user:
                 zone_color = '#1A9641'  # Green
             else:
                 zone_color = '#D7191C'  # Red
@@ -94,43 +117,100 @@ class FoliumGUI(GUI):
 
 
     def draw_graph(self, graph):
+        if self.geojson:
+            self.data_layers['edges'] = EdgeLayer(graph).add_to(self.map)
+            return
+
         graph_group = folium.FeatureGroup(name='Graph Lines', show=True).add_to(self.map)
 
-        for node in graph.nodes:
-            for edge in node.edges:
-                start_coordinate = edge.start.zone.coordinate
-                finish_coordinate = edge.finish.zone.coordinate
-                halfway_coordinate = start_coordinate + (finish_coordinate - start_coordinate) / 2
-                third_way_coordinate = start_coordinate + (finish_coordinate - start_coordinate) / 3
-
-                folium.PolyLine([start_coordinate.as_list(), halfway_coordinate.as_list()], color='black', weight=2).add_to(graph_group)
-
-                nametag_html = f"""
-                    <div style="width: 30px; height: 20px; text-align: center;
-                                line-height: 0.5; font-weight: bold; color: black;">
-                        <p>{edge.cost:.2f}</p>
-                    </div>
-                """
-                folium.Marker(
-                    location=third_way_coordinate.as_list(),
-                    icon=folium.DivIcon(icon_size=(30, 20),
-                                        icon_anchor=(15, 10),
-                                        html=nametag_html)
-                ).add_to(graph_group)
+        # Read edge endpoints directly from the graph arrays
+        start_lats, start_lons = graph.lats[graph.sources], graph.lons[graph.sources]
+        finish_lats, finish_lons = graph.lats[graph.targets], graph.lons[graph.targets]
+        halfway_lats = start_lats + (finish_lats - start_lats) / 2
+        halfway_lons = start_lons + (finish_lons - start_lons) / 2
+        third_way_lats = start_lats + (finish_lats - start_lats) / 3
+        third_way_lons = start_lons + (finish_lons - start_lons) / 3
+
+        for k in range(graph.num_edges):
+            folium.PolyLine([[start_lats[k], start_lons[k]], [halfway_lats[k], halfway_lons[k]]], color='black', weight=2).add_to(graph_group)
+
+            nametag_html = f"""
+                <div style="width: 30px; height: 20px; text-align: center;
+                            line-height: 0.5; font-weight: bold; color: black;">
+                    <p>{graph.costs[k]:.2f}</p>
+                </div>
+            """
+            folium.Marker(
+                location=[third_way_lats[k], third_way_lons[k]],
+                icon=folium.DivIcon(icon_size=(30, 20),
+                                    icon_anchor=(15, 10),
+                                    html=nametag_html)
+            ).add_to(graph_group)
 
 
     def draw_path(self, path_points):
+        if self.geojson:
+            self.data_layers['path'] = PathLayer(path_points).add_to(self.map)
+            return
+
         path_group = folium.FeatureGroup(name='Bike Path', show=True).add_to(self.map)
         folium.PolyLine(path_points, color='red', weight=4).add_to(path_group)
 
 
+    def update_zones(self, zones, date=None):
+        """Update owners, points per hour and values of zones drawn in geojson mode, e.g. after a feed poll"""
+        date = date or datetime.now()
+        self.data_layers['zones'].data['state'] = zone_state(zones, date, self.current_user)
+
+
     def save_map(self, filename):
-        folium.LayerControl().add_to(self.map)
+        if self.layer_control is None:
+            self.layer_control = folium.LayerControl().add_to(self.map)
+
+        if self.live_data is not None:
+            self._save_live_map(filename)
+            return
 
         print('Saving map to', filename)
         self.map.save(filename)
 
 
+    def _save_live_map(self, filename):
+        """Write the shell and the data files of every layer, skipping files that have not changed"""
+        directory = os.path.dirname(filename) or '.'
+        prefix = os.path.splitext(os.path.basename(filename))[0]
+        os.makedirs(directory, exist_ok=True)
+
+        manifest = {}
+        written = []
+        for layer in self.data_layers.values():
+            layer.bind(self.live_data, prefix)
+            hashes, layer_written = layer.write_data(directory)
+            manifest.update(hashes)
+            written.extend(layer_written)
+
+        manifest_filename = f'{prefix}_manifest.json'
+        self.live_data.manifest = manifest_filename
+        if write_if_changed(os.path.join(directory, manifest_filename), json.dumps(manifest, sort_keys=True)):
+            written.append(manifest_filename)
+
+        # Rendering adds elements to the map, so render a copy. Element names are random by default, number
+        # them so the shell is only rewritten when it really changes.
+        shell = copy.deepcopy(self.map)
+        for element, k in zip(self._walk(shell), itertools.count()):
+            element._id = f'{k:04d}'
+        if write_if_changed(filename, shell.get_root().render()):
+            written.append(os.path.basename(filename))
+
+        print(f"Saving live map to {filename}, wrote {', '.join(written) if written else 'nothing, no changes'}.")
+
+
+    def _walk(self, element):
+        yield element
+        for child in element._children.values():
+            yield from self._walk(child)
+
+
 '''
     def draw_map(self, m, area, graph, path):
         southWest = area['southWest']
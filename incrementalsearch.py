@@ -0,0 +1,233 @@
+import heapq
+
+import numpy as np
+
+from graph import Graph, Node
+from util import sl_distances
+
+
+class IncrementalSearch:
+    """
+    Cheapest path from start to finish that is repaired instead of recomputed when zone values or edge
+    costs change (D* Lite). The search runs backwards from finish, so g[i] is the cost from node i to
+    finish, and a change only reprocesses the nodes whose cost to finish actually changes.
+    The start can be moved along the path (for example as the route is ridden) without starting over.
+
+    Changes must be made through update_zone_values and update_edge_costs. If the graph is changed in
+    any other way, the search is started over on the next call to path.
+    """
+    def __init__(self, graph: Graph, start: Node, finish: Node):
+        self.graph = graph
+        self.start = start.index
+        self.finish = finish.index
+        self.expanded = 0   # Nodes taken from the queue, for comparing with a full search
+        self._reset()
+
+    def _reset(self):
+        """Forget all search state, the next call to path searches from scratch"""
+        n = len(self.graph.nodes)
+        self.g = [float('inf')] * n
+        self.rhs = [float('inf')] * n
+        self.km = 0.0
+        self.queue = []
+        self.queued_keys = [None] * n   # Key of each node in the queue, None if not queued
+        self.predecessors = self._predecessors()
+        self.max_value = self._required_max_value(np.arange(self.graph.num_edges))
+        self._update_heuristic()
+        self._version = self.graph.version
+
+        self.rhs[self.finish] = 0.0
+        self._push(self.finish)
+
+    def path(self):
+        """Cheapest path from start to finish as a list of nodes (empty if unreachable)"""
+        self._check_version()
+        self._compute_shortest_path()
+        if self.g[self.start] == float('inf'):
+            return []
+
+        offsets, targets, edge_costs = self.graph.adjacency()
+        path = [self.graph.nodes[self.start]]
+        current = self.start
+        while current != self.finish:
+            best_cost = float('inf')
+            best = None
+            for position in range(offsets[current], offsets[current + 1]):
+                cost = edge_costs[position] + self.g[targets[position]]
+                if cost < best_cost:
+                    best_cost = cost
+                    best = targets[position]
+            current = best
+            path.append(self.graph.nodes[current])
+        return path
+
+    @property
+    def cost(self):
+        """Cost of the cheapest path, as of the last call to path"""
+        return self.g[self.start]
+
+    def move_start(self, start: Node):
+        """Continue from a new start node, keeping what is known about the costs to finish"""
+        self.km += self.heuristic[start.index]
+        self.start = start.index
+        self._update_heuristic()
+
+    def update_zone_values(self, values: dict):
+        """
+        Apply new zone values, given as a dict mapping nodes (or node indices) to values. The graph is
+        updated with Graph.update_zone_values, which may also add and remove edges.
+        """
+        changed = np.array([key.index if isinstance(key, Node) else key for key in values], dtype=np.intp)
+        if len(changed) == 0:
+            return
+        self._check_version()
+        new_values = self.graph.values.copy()
+        new_values[changed] = list(values.values())
+
+        # Edges into changed zones are recomputed, added or removed, so both the old and the new sources are affected
+        affected = set()
+        for node in changed.tolist():
+            affected.update(self.predecessors[node])
+        self.graph.update_zone_values(new_values)
+
+        # Only edges into changed zones can have been added or removed
+        positions = self._edges_into(changed)
+        for node in changed.tolist():
+            self.predecessors[node] = []
+        for source, target in zip(self.graph.sources[positions].tolist(), self.graph.targets[positions].tolist()):
+            self.predecessors[target].append(source)
+            affected.add(source)
+        self._apply(affected, positions)
+
+    def update_edge_costs(self, positions, costs):
+        """Set new costs for the edges at the given positions in the graph's CSR arrays"""
+        positions = np.asarray(positions, dtype=np.intp)
+        if len(positions) == 0:
+            return
+        self._check_version()
+        self.graph.set_edge_costs(positions, costs)
+        self._apply(set(self.graph.sources[positions].tolist()), positions)
+
+    def _apply(self, affected, positions):
+        """Repair the search after the edges at positions changed, affected are the nodes whose edges changed"""
+        self._version = self.graph.version
+
+        # The heuristic has to stay below the cost of every edge. Costs to finish don't depend on it,
+        # so if it has to be lowered only the queue needs new keys
+        required = self._required_max_value(positions)
+        if required > self.max_value:
+            self.max_value = required
+            self._update_heuristic()
+            self._rekey()
+
+        self.successors = self.graph.adjacency()
+        for node in affected:
+            self._update_vertex(node)
+
+    def _check_version(self):
+        if self.graph.version != self._version:
+            print("Graph changed outside of the incremental search, searching from scratch.")
+            self._reset()
+
+    def _required_max_value(self, positions):
+        """Lowest max_value for which the straight line heuristic stays admissible on the edges at positions"""
+        if len(positions) == 0:
+            return 0.0
+        sources, targets = self.graph.sources[positions], self.graph.targets[positions]
+        distances = sl_distances(self.graph.lats[sources], self.graph.lons[sources],
+                                 self.graph.lats[targets], self.graph.lons[targets])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = distances / self.graph.costs[positions]
+        ratios[distances == 0] = 0
+        if np.isnan(ratios).any():
+            return float('inf')
+        return float(ratios.max())
+
+    def _update_heuristic(self):
+        """Straight line distance from start to every node divided by max_value, never more than the real cost"""
+        if self.max_value == 0 or self.max_value == float('inf'):
+            self.heuristic = [0.0] * len(self.graph.nodes)
+            return
+        distances = sl_distances(self.graph.lats, self.graph.lons,
+                                 self.graph.lats[self.start], self.graph.lons[self.start])
+        self.heuristic = (distances / self.max_value).tolist()
+
+    def _predecessors(self):
+        """Sources of the edges into every node, as a list of lists"""
+        order = np.argsort(self.graph.targets, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(self.graph.targets, minlength=len(self.graph.nodes))))).tolist()
+        sources = self.graph.sources[order].tolist()
+        return [sources[offsets[k]:offsets[k + 1]] for k in range(len(self.graph.nodes))]
+
+    def _edges_into(self, nodes):
+        """Positions of the edges into nodes"""
+        return np.flatnonzero(np.isin(self.graph.targets, nodes))
+
+    def _rekey(self):
+        """Recompute the keys of all queued nodes, needed when the heuristic got smaller"""
+        self.km = 0.0
+        queued = [node for node, key in enumerate(self.queued_keys) if key is not None]
+        self.queue = []
+        for node in queued:
+            self._push(node)
+
+    def _key(self, node: int):
+        best = min(self.g[node], self.rhs[node])
+        return (best + self.heuristic[node] + self.km, best)
+
+    def _push(self, node: int):
+        key = self._key(node)
+        self.queued_keys[node] = key
+        heapq.heappush(self.queue, (key, node))
+
+    def _top(self):
+        """Smallest valid key in the queue, dropping entries for nodes that were removed or requeued"""
+        while self.queue:
+            key, node = self.queue[0]
+            if self.queued_keys[node] == key:
+                return key, node
+            heapq.heappop(self.queue)
+        return (float('inf'), float('inf')), None
+
+    def _update_vertex(self, node: int):
+        if node != self.finish:
+            offsets, targets, edge_costs = self.successors
+            best = float('inf')
+            for position in range(offsets[node], offsets[node + 1]):
+                cost = edge_costs[position] + self.g[targets[position]]
+                if cost < best:
+                    best = cost
+            self.rhs[node] = best
+
+        if self.g[node] != self.rhs[node]:
+            self._push(node)
+        else:
+            self.queued_keys[node] = None
+
+    def _compute_shortest_path(self):
+        predecessors = self.predecessors
+        self.successors = self.graph.adjacency()
+        while True:
+            key, node = self._top()
+            start = self.start
+            if not (key < self._key(start) or self.rhs[start] != self.g[start]):
+                return
+            if node is None:
+                return
+
+            heapq.heappop(self.queue)
+            self.queued_keys[node] = None
+            self.expanded += 1
+
+            new_key = self._key(node)
+            if key < new_key:
+                self._push(node)
+            elif self.g[node] > self.rhs[node]:
+                self.g[node] = self.rhs[node]
+                for predecessor in predecessors[node]:
+                    self._update_vertex(predecessor)
+            else:
+                self.g[node] = float('inf')
+                for predecessor in predecessors[node]:
+                    self._update_vertex(predecessor)
+                self._update_vertex(node)
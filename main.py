@@ -8,6 +8,8 @@ from gui import FoliumGUI
 from zonestats import ZoneStats
 from turfclasses import Coordinate, User, Round
 from turfapi import TurfAPI
+from visitstore import VisitStore
+from zonecache import ZoneCache
 from zundin_scraper import ZundinScraper
 
 
@@ -24,16 +26,18 @@ if __name__ == "__main__":
     print(f"Previous round ID: {last_round_id}")
 
     # Fetch zones in the area
-    turf_api = TurfAPI()
+    turf_api = TurfAPI(zone_cache=ZoneCache())
     zones = turf_api.fetch_zones_in_area(northeast, southwest)
 
     # Add zone stats to each zone
-    # TODO: Turn into function? Parallelize
-    scraper = ZundinScraper()
+    scraper = ZundinScraper(store=VisitStore())    # Import old CSVs once with: python visitstore.py
+    visits = scraper.get_visits_data_many([zone.name for zone in zones], last_round_id)
     for zone in zones:
-        visits_df = scraper.get_visits_data(zone.name, last_round_id)
+        visits_df = visits[(zone.name, last_round_id)]
         stats = ZoneStats(zone.name, visits_df)
         zone.stats = stats
+    # Fit the hold time profiles used by method='fourier' for all zones at once
+    ZoneStats.fit_hold_time_profiles([zone.stats for zone in zones])
 
     # Create graph
     graph = build_graph(zones, datetime.now())
@@ -46,7 +50,7 @@ if __name__ == "__main__":
     # path = gh_api.get_bike_route(start, finish)
 
     # Draw map
-    gui = FoliumGUI(center)
+    gui = FoliumGUI(center, geojson=True)
     gui.draw_bbox(northeast, southwest)
     gui.draw_zones(zones)
     gui.draw_graph(graph)
@@ -57,13 +61,9 @@ if __name__ == "__main__":
 '''
     # Scrape takeover data for a specific zone
     zone_name = "Resecentrum"
-    full_visits_df = pd.DataFrame()
-    for round_id in range(160, 172):
-        round_visits_df = scraper.get_visits_data(zone_name, round_id)
-        full_visits_df = pd.concat([full_visits_df, round_visits_df], ignore_index=True)
+    zone_stats = ZoneStats.from_rounds(zone_name, range(160, 172), scraper)
 
     # Cool statistics B)
-    zone_stats = ZoneStats(zone_name, full_visits_df)
     estimated_hold_time = zone_stats.estimate_hold_time(datetime.now(), method='mean')
     zone_stats.hourly_histogram()
     zone_stats.daily_histogram()
@@ -0,0 +1,336 @@
+from datetime import datetime
+import hashlib
+import json
+import os
+from typing import List
+
+from branca.element import MacroElement
+from folium.map import Layer
+from folium.plugins import MarkerCluster
+from folium.template import Template
+import numpy as np
+
+from graph import Graph
+from turfclasses import Zone
+
+
+def zone_features(zones: List[Zone]):
+    """Zones as a GeoJSON FeatureCollection with the properties that rarely change"""
+    features = []
+    for zone in zones:
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [round(zone.coordinate.lon, 6), round(zone.coordinate.lat, 6)]},
+            'properties': {'id': zone.id, 'name': zone.name, 'tp': zone.takeover_points},
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def zone_state(zones: List[Zone], date: datetime, current_user: str=None):
+    """
+    Properties that change with takeovers, as a dict mapping zone id to [own, points per hour, value].
+    Values that are not finite (e.g. zones without takeovers this round) are None, NaN is not valid JSON.
+    """
+    state = {}
+    for zone in zones:
+        value = zone.value(date)
+        state[zone.id] = [int(zone.current_owner is not None and zone.current_owner.name == current_user),
+                          zone.points_per_hour, round(float(value), 1) if np.isfinite(value) else None]
+    return state
+
+
+def edge_features(graph: Graph):
+    """
+    Graph edges as one GeoJSON MultiLineString (each edge drawn from its start to halfway, so the
+    direction is visible) and cost labels at a third of the way as [lat, lon, cost] rows.
+    """
+    start_lats, start_lons = graph.lats[graph.sources], graph.lons[graph.sources]
+    finish_lats, finish_lons = graph.lats[graph.targets], graph.lons[graph.targets]
+    halfway_lats = start_lats + (finish_lats - start_lats) / 2
+    halfway_lons = start_lons + (finish_lons - start_lons) / 2
+    third_way_lats = start_lats + (finish_lats - start_lats) / 3
+    third_way_lons = start_lons + (finish_lons - start_lons) / 3
+
+    # GeoJSON coordinates are [lon, lat], shape (edges, 2 points, 2)
+    lines = np.stack((np.stack((start_lons, start_lats), axis=1), np.stack((halfway_lons, halfway_lats), axis=1)), axis=1)
+    geometry = {'type': 'MultiLineString', 'coordinates': np.round(lines, 6).tolist()}
+    labels = np.stack((np.round(third_way_lats, 6), np.round(third_way_lons, 6), np.round(graph.costs, 2)), axis=1).tolist()
+    for label in labels:
+        if not np.isfinite(label[2]):
+            label[2] = None     # NaN is not valid JSON
+    return {'type': 'Feature', 'geometry': geometry, 'properties': {}}, labels
+
+
+def write_if_changed(filename: str, text: str):
+    """Write text to filename unless the file already has exactly that content, returns True if written"""
+    if os.path.exists(filename):
+        with open(filename, 'r', encoding='utf-8') as file:
+            if file.read() == text:
+                return False
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write(text)
+    return True
+
+
+class LiveData(MacroElement):
+    """
+    Loads layer data from JSON files next to the page. manifest lists every data file with a hash of its
+    content, it is fetched every interval seconds and only files whose hash changed are fetched again.
+    Must be added to the map before the layers that use it.
+    """
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var watchers = {};
+                var versions = {};
+
+                function poll() {
+                    fetch({{ this.manifest|tojson }} + '?t=' + Date.now())
+                        .then(function (response) { return response.json(); })
+                        .then(function (manifest) {
+                            Object.keys(watchers).forEach(function (file) {
+                                if (manifest[file] === undefined || manifest[file] === versions[file]) {
+                                    return;
+                                }
+                                versions[file] = manifest[file];
+                                fetch(file + '?v=' + manifest[file])
+                                    .then(function (response) { return response.json(); })
+                                    .then(function (data) {
+                                        watchers[file].forEach(function (callback) { callback(data); });
+                                    });
+                            });
+                        })
+                        .catch(function (error) { console.log('Could not load map data', error); });
+                }
+                poll();
+                setInterval(poll, {{ this.interval * 1000 }});
+
+                return {
+                    watch: function (file, callback) {
+                        (watchers[file] = watchers[file] || []).push(callback);
+                    }
+                };
+            })();
+        {% endmacro %}"""
+    )
+
+    def __init__(self, manifest: str, interval: float=30):
+        super().__init__()
+        self._name = 'LiveData'
+        self.manifest = manifest
+        self.interval = interval
+
+
+class DataMixin:
+    """
+    For layers whose data is either embedded in the page or, after bind, loaded from JSON files through LiveData.
+    data maps a role (e.g. 'zones') to the data the layer's script gets for it.
+    """
+    def set_data(self, data: dict):
+        self.data = data
+        self.live = None
+        self.files = {}
+
+    def bind(self, live: LiveData, prefix: str):
+        """Load the data from {prefix}_{role}.json instead of embedding it"""
+        self.live = live
+        self.files = {role: f'{prefix}_{role}.json' for role in self.data}
+
+    def load(self, role: str, callback: str):
+        """JavaScript that calls the function named callback with the data for role"""
+        if self.live is None:
+            # Escaped like folium's tojson, so names can't close the script tag
+            text = json.dumps(self.data[role], separators=(',', ':')).replace('<', '\\u003c')
+            return f'({callback})({text});'
+        return f'{self.live.get_name()}.watch({json.dumps(self.files[role])}, {callback});'
+
+    def write_data(self, directory: str):
+        """Write the data files of a bound layer, returns {filename: content hash} and the files that were written"""
+        hashes = {}
+        written = []
+        for role, filename in self.files.items():
+            text = json.dumps(self.data[role], separators=(',', ':'))
+            hashes[filename] = hashlib.sha1(text.encode()).hexdigest()[:12]
+            if write_if_changed(os.path.join(directory, filename), text):
+                written.append(filename)
+        return hashes, written
+
+
+class ZoneLayer(DataMixin, MarkerCluster):
+    """
+    All zones as one GeoJSON FeatureCollection in a clustered layer, with owners, points per hour and values
+    kept separately so they can be updated on their own. Markers, name tags and popups are built in the
+    browser from the feature properties, popups only when they are opened, so the page holds the zone
+    data once instead of the HTML for every marker.
+    """
+    _template = Template(
+        """
+        {% macro header(this, kwargs) %}
+            <style>
+                .zone-icon { width: 24px; height: 24px; border-radius: 50%; border: 2px solid;
+                             background-color: white; color: black; text-align: center;
+                             line-height: 24px; font-weight: bold; }
+                .leaflet-tooltip.zone-name { background-color: rgba(0, 0, 0, 0.5); border: none;
+                                             border-radius: 5px; box-shadow: none; color: white;
+                                             font-weight: bold; text-align: center; }
+                .leaflet-tooltip.zone-name::before { display: none; }
+            </style>
+        {% endmacro %}
+
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var cluster = L.markerClusterGroup({{ this.options|tojavascript }});
+                var zones = null;
+                var state = null;
+
+                function escape(text) {
+                    var div = document.createElement('div');
+                    div.textContent = text;
+                    return div.innerHTML;
+                }
+
+                function formatValue(value) {
+                    return value === null ? 'n/a' : value.toFixed(1);
+                }
+
+                function properties(feature) {
+                    var p = feature.properties;
+                    var s = state[p.id] || [0, 0, 0];
+                    return {id: p.id, name: p.name, tp: p.tp, own: s[0], pph: s[1], value: s[2]};
+                }
+
+                function build() {
+                    if (zones === null || state === null) {
+                        return;
+                    }
+                    cluster.clearLayers();
+                    L.geoJSON(zones, {
+                        pointToLayer: function (feature, latlng) {
+                            var p = properties(feature);
+                            var color = p.own ? '#1A9641' : '#D7191C';
+                            var icon = L.divIcon({
+                                className: '',
+                                iconSize: [28, 28],
+                                iconAnchor: [14, 14],
+                                html: '<div class="zone-icon" style="border-color: ' + color + '">' + p.pph + '</div>'
+                            });
+                            return L.marker(latlng, {icon: icon});
+                        },
+                        onEachFeature: function (feature, layer) {
+                            var p = properties(feature);
+                            layer.bindPopup(function () {
+                                return '<div style="width: 300px;">'
+                                    + '<h4>' + escape(p.name) + '</h4>'
+                                    + '<p>Points: <b>' + p.tp + ' / +' + p.pph + '</b></p>'
+                                    + '<p>Value: ' + formatValue(p.value) + '</p>'
+                                    + '<img style="max-width: 100%; height: auto; padding-top: 10px;" '
+                                    + 'src="https://warded.se/turf/img/zones/' + p.id + 'UTC.png">'
+                                    + '</div>';
+                            }, {maxWidth: 320});
+                            {%- if this.show_names %}
+                            layer.bindTooltip(escape(p.name) + '<br>' + p.tp + ' / +' + p.pph + ' (~' + formatValue(p.value) + ')',
+                                              {permanent: true, direction: 'bottom', offset: [0, 14], className: 'zone-name'});
+                            {%- endif %}
+                        }
+                    }).addTo(cluster);
+                }
+
+                {{ this.load('zones', 'function (data) { zones = data; build(); }') }}
+                {{ this.load('state', 'function (data) { state = data; build(); }') }}
+
+                cluster.addTo({{ this._parent.get_name() }});
+                return cluster;
+            })();
+        {% endmacro %}"""
+    )
+
+    def __init__(self, zones: dict, state: dict, name: str='Zones', show_names: bool=True,
+                 disable_clustering_at_zoom: int=15, **kwargs):
+        super().__init__(name=name, disableClusteringAtZoom=disable_clustering_at_zoom, **kwargs)
+        self._name = 'ZoneLayer'
+        self.set_data({'zones': zones, 'state': state})
+        self.show_names = show_names
+
+
+class EdgeLayer(DataMixin, Layer):
+    """
+    All graph edges as one GeoJSON MultiLineString. Cost labels are only created when the map is zoomed in
+    to at least label_min_zoom, and only for the labels inside the visible area.
+    """
+    _template = Template(
+        """
+        {% macro header(this, kwargs) %}
+            <style>
+                .edge-cost { width: 30px; height: 20px; text-align: center; line-height: 20px;
+                             font-weight: bold; color: black; }
+            </style>
+        {% endmacro %}
+
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var map = {{ this._parent.get_name() }};
+                var group = L.featureGroup();
+                var lines = L.geoJSON(null, {style: {color: {{ this.color|tojson }}, weight: {{ this.weight }}}, interactive: false}).addTo(group);
+                var labelGroup = L.layerGroup().addTo(group);
+                var labels = [];
+
+                function updateLabels() {
+                    labelGroup.clearLayers();
+                    if (map.getZoom() < {{ this.label_min_zoom }}) {
+                        return;
+                    }
+                    var bounds = map.getBounds();
+                    for (var i = 0; i < labels.length; i++) {
+                        var label = labels[i];
+                        if (!bounds.contains([label[0], label[1]])) {
+                            continue;
+                        }
+                        labelGroup.addLayer(L.marker([label[0], label[1]], {
+                            interactive: false,
+                            icon: L.divIcon({className: '', iconSize: [30, 20], iconAnchor: [15, 10],
+                                             html: '<div class="edge-cost">' + (label[2] === null ? 'n/a' : label[2].toFixed(2)) + '</div>'})
+                        }));
+                    }
+                }
+                map.on('zoomend moveend', updateLabels);
+
+                {{ this.load('edges', 'function (data) { lines.clearLayers(); lines.addData(data.lines); labels = data.labels; updateLabels(); }') }}
+
+                group.addTo(map);
+                return group;
+            })();
+        {% endmacro %}"""
+    )
+
+    def __init__(self, graph: Graph, name: str='Graph Lines', label_min_zoom: int=16, color: str='black', weight: int=2, **kwargs):
+        lines, labels = edge_features(graph)
+        super().__init__(name=name, overlay=True, **kwargs)
+        self._name = 'EdgeLayer'
+        self.set_data({'edges': {'lines': lines, 'labels': labels}})
+        self.label_min_zoom = label_min_zoom
+        self.color = color
+        self.weight = weight
+
+
+class PathLayer(DataMixin, Layer):
+    """A path given as [lat, lon] points, drawn as one line"""
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var line = L.polyline([], {color: {{ this.color|tojson }}, weight: {{ this.weight }}});
+                {{ this.load('path', 'function (data) { line.setLatLngs(data); }') }}
+                line.addTo({{ this._parent.get_name() }});
+                return line;
+            })();
+        {% endmacro %}"""
+    )
+
+    def __init__(self, points, name: str='Bike Path', color: str='red', weight: int=4, **kwargs):
+        points = np.round(np.asarray(points, dtype=np.float64).reshape(-1, 2), 6).tolist()
+        super().__init__(name=name, overlay=True, **kwargs)
+        self._name = 'PathLayer'
+        self.set_data({'path': points})
+        self.color = color
+        self.weight = weight
@@ -0,0 +1,196 @@
+import random
+import time
+from typing import List
+
+import numpy as np
+
+from graph import Graph, Node
+
+
+class Tour:
+    """ Planned tour through zones, given as indices into the planner's matrices """
+    def __init__(self, indices: List[int], value: float, length: float):
+        self.indices = indices
+        self.value = value
+        self.length = length
+
+    def __str__(self):
+        return f"Tour of {len(self.indices)} zones, value {self.value:.1f}, length {self.length / 1000:.2f} km"
+
+    def nodes(self, graph: Graph):
+        return [graph.nodes[index] for index in self.indices]
+
+
+class OrienteeringPlanner:
+    """
+    Plan a tour from a start zone to a finish zone that collects as much value as possible within a
+    distance (or time) budget. distances[i, j] is the travel distance in meters from zone i to zone j,
+    for example a CostMatrix computed with weight='distance'. Zones passed on the way between two
+    tour stops are not counted.
+
+    Uses greedy insertion followed by 2-opt and Or-opt local search, then keeps perturbing the best
+    tour until patience perturbations in a row find nothing better or the time limit is reached.
+    The best tour so far is always available.
+    """
+    def __init__(self, distances: np.ndarray, values: np.ndarray, speed_kmh: float=15, seed: int=None):
+        self.distances = np.asarray(distances, dtype=np.float64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.speed_kmh = speed_kmh
+        self.random = random.Random(seed)
+
+    @staticmethod
+    def from_graph(graph: Graph, distances: np.ndarray, speed_kmh: float=15, seed: int=None):
+        """Planner for the zones of a graph, using the zone values the graph was built with"""
+        return OrienteeringPlanner(distances, graph.values, speed_kmh, seed)
+
+    def plan(self, start: int, finish: int, max_km: float=None, max_minutes: float=None,
+             time_limit: float=0.5, patience: int=50, callback=None):
+        """
+        Plan a tour from start to finish (zone indices, or graph nodes). The budget is max_km, or max_minutes
+        at speed_kmh, whichever is tighter. callback(tour) is called every time a better tour is found.
+        Returns the best tour found within time_limit seconds, or None if finish can't be reached in budget.
+        The search stops early once patience perturbed tours in a row were no better than the best one.
+        """
+        if isinstance(start, Node):
+            start = start.index
+        if isinstance(finish, Node):
+            finish = finish.index
+
+        budget = float('inf')
+        if max_km is not None:
+            budget = min(budget, max_km * 1000)
+        if max_minutes is not None:
+            budget = min(budget, max_minutes / 60 * self.speed_kmh * 1000)
+        if budget == float('inf'):
+            raise ValueError("Either max_km or max_minutes must be given.")
+
+        deadline = time.perf_counter() + time_limit
+        tour = [start, finish]
+        if self._length(tour) > budget:
+            return None
+
+        self._insert_greedy(tour, budget)
+        self._local_search(tour, budget, deadline)
+        best = self._make_tour(tour)
+        if callback:
+            callback(best)
+
+        stale = 0
+        while stale < patience and time.perf_counter() < deadline:
+            stale += 1
+            tour = list(best.indices)
+            self._perturb(tour)
+            self._insert_greedy(tour, budget, noise=0.3)
+            self._local_search(tour, budget, deadline)
+            candidate = self._make_tour(tour)
+            if (candidate.value, -candidate.length) > (best.value, -best.length):
+                best = candidate
+                stale = 0
+                if callback:
+                    callback(best)
+
+        return best
+
+    def _make_tour(self, tour):
+        return Tour(list(tour), self._value(tour), self._length(tour))
+
+    def _length(self, tour):
+        tour = np.asarray(tour)
+        return float(self.distances[tour[:-1], tour[1:]].sum())
+
+    def _value(self, tour):
+        return float(self.values[list(set(tour))].sum())
+
+    def _insert_greedy(self, tour, budget, noise=0.0):
+        """Insert the zone with the best value per added distance until nothing more fits in the budget"""
+        length = self._length(tour)
+        unvisited = np.ones(len(self.values), dtype=bool)
+        unvisited[tour] = False
+
+        while True:
+            candidates = np.flatnonzero(unvisited & np.isfinite(self.values) & (self.values > 0))
+            if len(candidates) == 0:
+                return
+
+            before, after = np.asarray(tour[:-1]), np.asarray(tour[1:])
+            added = (self.distances[np.ix_(before, candidates)] + self.distances[np.ix_(candidates, after)].T
+                     - self.distances[before, after][:, np.newaxis])
+            feasible = length + added <= budget
+            if not feasible.any():
+                return
+
+            # Best insertion position for every candidate, then the candidate with the best ratio
+            added = np.where(feasible, added, np.inf)
+            positions = added.argmin(axis=0)
+            added_best = added[positions, np.arange(len(candidates))]
+            ratios = self.values[candidates] / (np.maximum(added_best, 0) + 1)
+            if noise:
+                ratios = ratios * (1 + noise * np.array([self.random.random() for _ in candidates]))
+            ratios[~np.isfinite(added_best)] = -1
+
+            k = int(ratios.argmax())
+            tour.insert(int(positions[k]) + 1, int(candidates[k]))
+            unvisited[candidates[k]] = False
+            length += added_best[k]
+
+    def _local_search(self, tour, budget, deadline):
+        """Shorten the tour with 2-opt and Or-opt, and fill freed up budget with new zones"""
+        improved = True
+        while improved and time.perf_counter() < deadline:
+            improved = self._two_opt(tour) or self._or_opt(tour)
+            if improved:
+                self._insert_greedy(tour, budget)
+
+    def _two_opt(self, tour):
+        """Apply the best segment reversal that shortens the tour, distances may be asymmetric"""
+        if len(tour) < 4:
+            return False
+
+        t = np.asarray(tour)
+        forward = np.concatenate(([0], np.cumsum(self.distances[t[:-1], t[1:]])))
+        backward = np.concatenate(([0], np.cumsum(self.distances[t[1:], t[:-1]])))
+
+        # Reverse the segment tour[i:j + 1], keeping the endpoints in place
+        i = np.arange(1, len(t) - 1)[:, np.newaxis]
+        j = np.arange(1, len(t) - 1)[np.newaxis, :]
+        valid = j > i
+        i_, j_ = np.broadcast_arrays(i, j)
+        i_, j_ = i_[valid], j_[valid]
+        delta = (self.distances[t[i_ - 1], t[j_]] + self.distances[t[i_], t[j_ + 1]]
+                 - self.distances[t[i_ - 1], t[i_]] - self.distances[t[j_], t[j_ + 1]]
+                 + (backward[j_] - backward[i_]) - (forward[j_] - forward[i_]))
+
+        k = int(delta.argmin())
+        if delta[k] >= -1e-9:
+            return False
+        tour[i_[k]:j_[k] + 1] = tour[i_[k]:j_[k] + 1][::-1]
+        return True
+
+    def _or_opt(self, tour):
+        """Move a segment of 1 to 3 zones to the position where it shortens the tour the most"""
+        d = self.distances
+        for segment_length in (1, 2, 3):
+            for i in range(1, len(tour) - segment_length):
+                segment = tour[i:i + segment_length]
+                rest = tour[:i] + tour[i + segment_length:]
+                removed = d[tour[i - 1], segment[0]] + d[segment[-1], tour[i + segment_length]] - d[tour[i - 1], tour[i + segment_length]]
+                internal = sum(d[a, b] for a, b in zip(segment[:-1], segment[1:]))
+
+                before, after = np.asarray(rest[:-1]), np.asarray(rest[1:])
+                added = d[before, segment[0]] + internal + d[segment[-1], after] - d[before, after]
+                added[i - 1] = np.inf    # Same position as before
+                k = int(added.argmin())
+                if added[k] - internal < removed - 1e-9:
+                    tour[:] = rest[:k + 1] + segment + rest[k + 1:]
+                    return True
+        return False
+
+    def _perturb(self, tour):
+        """Remove a few random zones from the tour"""
+        inner = len(tour) - 2
+        if inner <= 0:
+            return
+        for _ in range(self.random.randint(1, max(1, inner // 4))):
+            del tour[self.random.randint(1, len(tour) - 2)]
+            if len(tour) <= 2:
+                return
@@ -0,0 +1,41 @@
+import threading
+import time
+
+
+class QuotaExceededError(Exception):
+    """ Raised when a rate limiter has no requests left in its quota """
+
+
+class RateLimiter:
+    """ Thread safe limiter for requests per second and an optional total request quota """
+    def __init__(self, requests_per_second: float=None, quota: int=None):
+        self.requests_per_second = requests_per_second
+        self.quota = quota
+        self.used = 0
+
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    @property
+    def remaining(self):
+        if self.quota is None:
+            return None
+        return max(self.quota - self.used, 0)
+
+    def acquire(self):
+        """Block until a request is allowed, raises QuotaExceededError if the quota is used up"""
+        with self._lock:
+            if self.quota is not None and self.used >= self.quota:
+                raise QuotaExceededError(f"Quota of {self.quota} requests used up")
+            self.used += 1
+
+            # Reserve the next free time slot, then sleep outside the lock
+            now = time.monotonic()
+            wait = 0.0
+            if self.requests_per_second:
+                slot = max(now, self._next_time)
+                self._next_time = slot + 1 / self.requests_per_second
+                wait = slot - now
+
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,129 @@
+import glob
+import json
+import os
+import sqlite3
+import threading
+from typing import List, Tuple
+
+from turfclasses import Coordinate
+
+
+class RouteStore:
+    """
+    Route cache in a single SQLite file, keyed by start and finish coordinates quantized to 4 decimals.
+    Each thread gets its own connection and the database uses WAL, so readers never block each other.
+    """
+    PRECISION = 4
+    KINDS = ('route', 'summary')
+
+    def __init__(self, filename: str='routes.db'):
+        self.filename = filename
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS routes (
+                start_lat INTEGER NOT NULL,
+                start_lon INTEGER NOT NULL,
+                finish_lat INTEGER NOT NULL,
+                finish_lon INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (start_lat, start_lon, finish_lat, finish_lon, kind)
+            ) WITHOUT ROWID
+        """)
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=30)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @classmethod
+    def quantize(cls, coordinate: Coordinate):
+        """
+        Quantize a coordinate to integer (lat, lon) with PRECISION decimals. Rounded through the same
+        string formatting as the old routes/*.json names, so migrated routes are found under the same keys.
+        """
+        scale = 10 ** cls.PRECISION
+        return (round(float(f'{coordinate.lat:.{cls.PRECISION}f}') * scale),
+                round(float(f'{coordinate.lon:.{cls.PRECISION}f}') * scale))
+
+    def key(self, start: Coordinate, finish: Coordinate):
+        return self.quantize(start) + self.quantize(finish)
+
+    def get(self, start: Coordinate, finish: Coordinate, kind: str='route'):
+        """Get a cached route (or summary), returns None if not cached"""
+        return self.get_many([(start, finish)], kind)[0]
+
+    def put(self, start: Coordinate, finish: Coordinate, data: dict, kind: str='route'):
+        self.put_many([(start, finish, data)], kind)
+
+    def get_many(self, pairs: List[Tuple[Coordinate, Coordinate]], kind: str='route'):
+        """Get cached data for a list of (start, finish) pairs, missing pairs are None"""
+        if not pairs:
+            return []
+
+        keys = [self.key(start, finish) for start, finish in pairs]
+        connection = self._connection()
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (start_lat, start_lon, finish_lat, finish_lon)")
+        connection.execute("DELETE FROM lookup")
+        connection.executemany("INSERT INTO lookup VALUES (?, ?, ?, ?)", set(keys))
+        rows = connection.execute("""
+            SELECT r.start_lat, r.start_lon, r.finish_lat, r.finish_lon, r.data
+            FROM lookup l JOIN routes r
+            ON r.start_lat = l.start_lat AND r.start_lon = l.start_lon
+            AND r.finish_lat = l.finish_lat AND r.finish_lon = l.finish_lon
+            WHERE r.kind = ?
+        """, (kind,)).fetchall()
+        connection.commit()
+
+        found = {tuple(row[:4]): row[4] for row in rows}
+        return [json.loads(found[key]) if key in found else None for key in keys]
+
+    def put_many(self, items: List[Tuple[Coordinate, Coordinate, dict]], kind: str='route'):
+        """Store data for a list of (start, finish, data) items in one transaction"""
+        rows = [self.key(start, finish) + (kind, json.dumps(data)) for start, finish, data in items]
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+
+    def migrate_json_dir(self, directory: str='routes'):
+        """One-time import of the old routes/*.json (and routes/summaries/*.json) cache files"""
+        connection = self._connection()
+        if connection.execute("SELECT 1 FROM meta WHERE key = 'migrated_json'").fetchone():
+            return 0
+
+        rows = []
+        for kind, pattern in (('route', '*.json'), ('summary', os.path.join('summaries', '*.json'))):
+            for filename in glob.glob(os.path.join(directory, pattern)):
+                try:
+                    start, finish = os.path.basename(filename)[:-len('.json')].split('_to_')
+                    start_lat, start_lon = start.split('_')
+                    finish_lat, finish_lon = finish.split('_')
+                    key = self.key(Coordinate(float(start_lat), float(start_lon)), Coordinate(float(finish_lat), float(finish_lon)))
+                    with open(filename, 'r') as file:
+                        data = file.read()
+                except ValueError:
+                    print(f"Skipping {filename}, not a route file.")
+                    continue
+                rows.append(key + (kind, data))
+
+        with self._write_lock:
+            with connection:
+                connection.executemany("INSERT OR IGNORE INTO routes VALUES (?, ?, ?, ?, ?, ?)", rows)
+                connection.execute("INSERT OR REPLACE INTO meta VALUES ('migrated_json', '1')")
+
+        if rows:
+            print(f"Migrated {len(rows)} cached routes from {directory} to {self.filename}.")
+        return len(rows)
@@ -0,0 +1,50 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from typing import List
+
+from turfclasses import Coordinate
+from util import EARTH_RADIUS, coordinate_arrays
+
+
+class SpatialIndex:
+    """ KD-tree over coordinates for fast radius queries in meters """
+    # Relative slack added to query radii to absorb floating point error,
+    # candidates should always be checked against sl_distance afterwards
+    RADIUS_SLACK = 1e-6
+
+    def __init__(self, coordinates: List[Coordinate]):
+        lats, lons = coordinate_arrays(coordinates)
+        lats, lons = np.radians(lats), np.radians(lons)
+
+        # Points on a sphere in 3D. The chord length between two points is
+        # monotonic in the great circle distance, so a ball query in this space
+        # returns exactly the points within a given haversine distance.
+        self.points = EARTH_RADIUS * np.column_stack((np.cos(lats) * np.cos(lons),
+                                                      np.cos(lats) * np.sin(lons),
+                                                      np.sin(lats))).reshape(-1, 3)
+        self.tree = cKDTree(self.points)
+
+    def __len__(self):
+        return len(self.points)
+
+    @staticmethod
+    def chord_length(distance):
+        """Convert great circle distance(s) in meters to chord length(s) in meters"""
+        angle = np.minimum(np.asarray(distance, dtype=float) / EARTH_RADIUS, np.pi)
+        return 2 * EARTH_RADIUS * np.sin(angle / 2)
+
+    def query_radius(self, index: int, radius: float):
+        """Return the indices of all points within radius meters of point index (including itself)"""
+        chord = self.chord_length(radius) * (1 + self.RADIUS_SLACK)
+        return self.tree.query_ball_point(self.points[index], chord)
+
+    def query_radii(self, radii, indices=None):
+        """
+        Return a list with the indices within radii[k] meters of point indices[k], for every k.
+        If indices is omitted, all points are queried in order.
+        """
+        points = self.points if indices is None else self.points[np.asarray(indices, dtype=np.intp)]
+        if len(points) == 0:
+            return []
+        chords = self.chord_length(radii) * (1 + self.RADIUS_SLACK)
+        return self.tree.query_ball_point(points, chords)
@@ -1,31 +1,191 @@
 import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import List
 
 from turfclasses import Coordinate, User, Region, Zone
+from zonecache import ZoneCache
 
 
 class TurfAPI:
     BASE_URL = "https://api.turfgame.com/v4/"
     TURF_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+    MIN_TILE_SIZE = 0.001   # Dense tiles are not split below this size in degrees
+    NAMES_PER_REQUEST = 50
 
-    def __init__(self):
-        pass
+    def __init__(self, base_url: str=BASE_URL, tile_size: float=0.02, tiles_per_request: int=4,
+                 max_workers: int=4, max_zones_per_tile: int=300, retries: int=3, retry_delay: float=1.0,
+                 zone_cache: ZoneCache=None):
+        """
+        Areas are fetched in tiles of tile_size degrees, tiles_per_request tiles in each POST.
+        Tiles with more than max_zones_per_tile zones are split in four and fetched again,
+        and failed tiles are retried individually up to retries times, after retry_delay seconds
+        doubled for every attempt.
+        If zone_cache is given, area queries are answered from it where possible.
+        """
+        self.base_url = base_url
+        self.zone_cache = zone_cache
+        self.tile_size = tile_size
+        self.tiles_per_request = tiles_per_request
+        self.max_workers = max_workers
+        self.max_zones_per_tile = max_zones_per_tile
+        self.retries = retries
+        self.retry_delay = retry_delay
 
-    def fetch_zones_in_area(self, north_east: Coordinate, south_west: Coordinate):
-        """Fetch zones in an area from the Turf API based on north-east and south-west coordinates"""
-        url = f"{self.BASE_URL}zones"
+    def fetch_zones_in_area(self, north_east: Coordinate, south_west: Coordinate, refresh_owners: bool=True):
+        """
+        Fetch zones in an area from the Turf API based on north-east and south-west coordinates.
+        With a zone cache, an area fetched within the static TTL is loaded from the cache. Zones in it whose
+        static attributes are older than the static TTL are fetched again by name, and with refresh_owners
+        only the owners and points per hour that are older than the dynamic TTL are fetched.
+        """
+        if self.zone_cache is None:
+            return self._fetch_zones_in_tiles(north_east, south_west)
+
+        if not self.zone_cache.is_area_fresh(north_east, south_west):
+            print("Area not cached. Fetching zones from Turf API.")
+            zones = self._fetch_zones_in_tiles(north_east, south_west)
+            self.zone_cache.put_zones(zones)
+            self.zone_cache.add_area(north_east, south_west)
+            return zones
+
+        zones = self.zone_cache.zones_in_area(north_east, south_west)
+        stale_static = self.zone_cache.stale_static(zones)
+        if stale_static:
+            self.refresh_zones(stale_static)
+        if refresh_owners:
+            stale_ids = {zone.id for zone in stale_static}
+            self.refresh_owners([zone for zone in self.zone_cache.stale_dynamic(zones) if zone.id not in stale_ids])
+        if stale_static or refresh_owners:
+            zones = self.zone_cache.zones_in_area(north_east, south_west)
+        print(f"Loaded {len(zones)} zones from cache.")
+        return zones
+
+    def refresh_zones(self, zones: List[Zone]):
+        """Fetch zones by name and store all their attributes in the zone cache"""
+        if not zones:
+            return []
+        print(f"Refreshing {len(zones)} zones.")
+        updated = self._fetch_zones_by_names([zone.name for zone in zones])
+        if self.zone_cache is not None:
+            self.zone_cache.put_zones(updated)
+        return updated
+
+    def refresh_owners(self, zones: List[Zone]):
+        """Fetch the current owner and points per hour of zones by name and update them in the zone cache"""
+        if not zones:
+            return []
+        print(f"Refreshing owners of {len(zones)} zones.")
+        updated = self._fetch_zones_by_names([zone.name for zone in zones])
+        if self.zone_cache is not None:
+            self.zone_cache.update_dynamic(updated)
+        return updated
+
+    def _fetch_zones_by_names(self, names):
+        """Fetch zones by name in batches of NAMES_PER_REQUEST, zones that fail to load are left out"""
+        batches = [names[k:k + self.NAMES_PER_REQUEST] for k in range(0, len(names), self.NAMES_PER_REQUEST)]
+        updated = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for data in executor.map(self._fetch_zones_by_name, batches):
+                if data is not None:
+                    updated.extend(self._parse_zones(data))
+        return updated
+
+    def _fetch_zones_by_name(self, names):
+        """POST a list of zone names, returns the response JSON or None on failure"""
+        url = f"{self.base_url}zones"
+        payload = [{"name": name} for name in names]
+        for _ in range(self.retries + 1):
+            try:
+                response = requests.post(url, json=payload, timeout=30)
+            except requests.RequestException as e:
+                print(f"Error fetching zones: {e}")
+                continue
+            if response.status_code == 200:
+                return response.json()
+            print(f"Error fetching zones: {response.status_code}")
+        return None
+
+    def _fetch_zones_in_tiles(self, north_east: Coordinate, south_west: Coordinate):
+        """Fetch all zones in an area from the Turf API, split into tiles"""
+        # Split the area into tiles, tiles are (north, east, south, west)
+        tiles = []
+        lat = south_west.lat
+        while lat < north_east.lat:
+            lon = south_west.lon
+            while lon < north_east.lon:
+                tiles.append((min(lat + self.tile_size, north_east.lat), min(lon + self.tile_size, north_east.lon), lat, lon))
+                lon += self.tile_size
+            lat += self.tile_size
+        if not tiles:
+            tiles = [(north_east.lat, north_east.lon, south_west.lat, south_west.lon)]
+
+        zones = {}
+        attempts = {tile: 0 for tile in tiles}
+        pending = [tiles[k:k + self.tiles_per_request] for k in range(0, len(tiles), self.tiles_per_request)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending:
+                batches, pending = pending, []
+                retry_attempt = 0
+                for batch, data in zip(batches, executor.map(self._fetch_tiles, batches)):
+                    if data is None:
+                        # Retry the tiles one by one, so a single bad tile doesn't fail the others
+                        for tile in batch:
+                            attempts[tile] += 1
+                            if attempts[tile] <= self.retries:
+                                pending.append([tile])
+                                retry_attempt = max(retry_attempt, attempts[tile])
+                            else:
+                                print(f"Giving up on tile {tile} after {self.retries} retries.")
+                        continue
+
+                    batch_zones = self._parse_zones(data)
+                    for tile in batch:
+                        tile_zones = [zone for zone in batch_zones if self._in_tile(zone.coordinate, tile)]
+                        if len(tile_zones) > self.max_zones_per_tile and tile[0] - tile[2] > self.MIN_TILE_SIZE:
+                            # Dense tile, the response may be cut off, so fetch it again in smaller tiles
+                            sub_tiles = self._split_tile(tile)
+                            attempts.update({sub_tile: 0 for sub_tile in sub_tiles})
+                            pending.append(sub_tiles)
+                        for zone in tile_zones:
+                            zones[zone.id] = zone
+
+                if retry_attempt:
+                    time.sleep(self.retry_delay * 2 ** (retry_attempt - 1))
+
+        return list(zones.values())
+
+    def _fetch_tiles(self, tiles):
+        """POST a list of tiles in one request, returns the response JSON or None on failure"""
+        url = f"{self.base_url}zones"
         payload = [{
-            "northEast": {"latitude": north_east.lat, "longitude": north_east.lon},
-            "southWest": {"latitude": south_west.lat, "longitude": south_west.lon}
-        }]
+            "northEast": {"latitude": north, "longitude": east},
+            "southWest": {"latitude": south, "longitude": west}
+        } for north, east, south, west in tiles]
 
-        response = requests.post(url, json=payload)
+        try:
+            response = requests.post(url, json=payload, timeout=30)
+        except requests.RequestException as e:
+            print(f"Error fetching zones: {e}")
+            return None
 
         if response.status_code == 200:
-            return self._parse_zones(response.json())
+            return response.json()
         else:
             print(f"Error fetching zones: {response.status_code}")
-            return []
+            return None
+
+    def _in_tile(self, coordinate: Coordinate, tile):
+        north, east, south, west = tile
+        return south <= coordinate.lat <= north and west <= coordinate.lon <= east
+
+    def _split_tile(self, tile):
+        north, east, south, west = tile
+        mid_lat = (north + south) / 2
+        mid_lon = (east + west) / 2
+        return [(north, east, mid_lat, mid_lon), (north, mid_lon, mid_lat, west),
+                (mid_lat, east, south, mid_lon), (mid_lat, mid_lon, south, west)]
 
     def _parse_zones(self, data):
         """Helper method to convert API data into Zone objects"""
@@ -132,11 +132,25 @@ class Zone:
     def distance_to(self, other_zone):
         return sl_distance(self.coordinate, other_zone.coordinate)
 
-    def value(self, date: datetime):
-        """Calculate the value of the zone at a specific time"""
+    def value(self, date: datetime, method='mean'):
+        """Calculate the value of the zone at a specific time, hold time estimates are cached by the stats"""
         if not self.stats:
             raise ValueError("Zone stats not set")
 
-        estimated_hold_hrs = self.stats.estimate_hold_time(date, method='mean') / 3600
+        estimated_hold_hrs = self.stats.estimate_hold_time(date, method=method) / 3600
         return self.takeover_points + self.points_per_hour * estimated_hold_hrs
 
+
+
+class Takeover:
+    """ Takeover class for representing a zone being taken by a user """
+    def __init__(self, zone: Zone, user: User, time: datetime):
+        self.zone = zone
+        self.user = user
+        self.time = time
+
+    def __str__(self):
+        return f"{self.user.name} took {self.zone.name} at {self.time}"
+
+    def __eq__(self, other):
+        return self.zone.id == other.zone.id and self.user.id == other.user.id and self.time == other.time
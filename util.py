@@ -8,18 +8,32 @@ import json
 TURF_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
 ZUNDIN_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 GRAPH_CONNECTEDNESS = 3
+EARTH_RADIUS = 6371000  # Earth radius in meters
 
 
 def sl_distance(coords1, coords2):
     """
     Calculate the straight line distance between two coordinates in meters.
     """
+    return sl_distances(coords1.lat, coords1.lon, coords2.lat, coords2.lon)
 
-    R = 6371000  # Earth radius in meters
-    phi1 = np.radians(coords1.lat)
-    phi2 = np.radians(coords2.lat)
-    delta_phi = np.radians(coords2.lat - coords1.lat)
-    delta_lambda = np.radians(coords2.lon - coords1.lon)
+
+def sl_distances(lats1, lons1, lats2, lons2, dtype=np.float64):
+    """
+    Calculate the straight line distances in meters between arrays of latitudes and longitudes.
+    The arrays are broadcast against each other, so this works both element-wise and for outer products.
+    """
+
+    R = EARTH_RADIUS
+    lats1 = np.asarray(lats1, dtype=dtype)
+    lons1 = np.asarray(lons1, dtype=dtype)
+    lats2 = np.asarray(lats2, dtype=dtype)
+    lons2 = np.asarray(lons2, dtype=dtype)
+
+    phi1 = np.radians(lats1)
+    phi2 = np.radians(lats2)
+    delta_phi = np.radians(lats2 - lats1)
+    delta_lambda = np.radians(lons2 - lons1)
 
     a = np.sin(delta_phi / 2) * np.sin(delta_phi / 2) + np.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2) * np.sin(delta_lambda / 2)
     c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
@@ -27,6 +41,42 @@ def sl_distance(coords1, coords2):
     return R * c
 
 
+def coordinate_arrays(coordinates):
+    """Split a list of coordinates into arrays of latitudes and longitudes."""
+    lats = np.array([coordinate.lat for coordinate in coordinates], dtype=np.float64)
+    lons = np.array([coordinate.lon for coordinate in coordinates], dtype=np.float64)
+    return lats, lons
+
+
+def sl_distance_matrix(lats1, lons1, lats2=None, lons2=None, dtype=np.float64):
+    """
+    Calculate the full matrix of straight line distances in meters, where element [i, j]
+    is the distance from point i in the first set to point j in the second set.
+    If the second set is omitted, the pairwise distances within the first set are calculated.
+    """
+    if lats2 is None or lons2 is None:
+        lats2, lons2 = lats1, lons1
+
+    lats1 = np.asarray(lats1, dtype=dtype)
+    lons1 = np.asarray(lons1, dtype=dtype)
+    return sl_distances(lats1[:, np.newaxis], lons1[:, np.newaxis], lats2, lons2, dtype=dtype)
+
+
+def sparse_sl_distance_matrix(lats, lons, rows, cols, dtype=np.float64):
+    """
+    Calculate straight line distances in meters only for the given (rows[k], cols[k]) pairs
+    of points and return them as a sparse CSR matrix of shape (n, n).
+    """
+    from scipy.sparse import csr_matrix
+
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    rows = np.asarray(rows, dtype=np.intp)
+    cols = np.asarray(cols, dtype=np.intp)
+    distances = sl_distances(lats[rows], lons[rows], lats[cols], lons[cols], dtype=dtype)
+    return csr_matrix((distances, (rows, cols)), shape=(len(lats), len(lats)), dtype=dtype)
+
+
 def get_round_start_from_date(date: datetime):
     """ Calculate datetime for round start of the given month (first sunday of the month at 12 pm). """
     first_weekday_of_month = date.replace(day=1).weekday()
@@ -35,8 +85,15 @@ def get_round_start_from_date(date: datetime):
     return round_start
 
 
-def simple_cost(zone1, zone2):
-    return sl_distance(zone1.coords, zone2.coords) / zone2.value
+def simple_cost(zone1, zone2, date: datetime):
+    return sl_distance(zone1.coordinate, zone2.coordinate) / zone2.value(date)
+
+
+def simple_cost_matrix(zones, date: datetime, dtype=np.float64):
+    """Calculate simple_cost between all pairs of zones, element [i, j] is the cost from zone i to zone j."""
+    lats, lons = coordinate_arrays([zone.coordinate for zone in zones])
+    values = np.array([zone.value(date) for zone in zones], dtype=dtype)
+    return sl_distance_matrix(lats, lons, dtype=dtype) / values[np.newaxis, :]
 
 
 def save_to_json(data: dict, filename: str):
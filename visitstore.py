@@ -0,0 +1,113 @@
+import glob
+import os
+import sys
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+
+class VisitStore:
+    """
+    Visit data for all zones and rounds in one Parquet dataset, partitioned by round_id and zone_name
+    (hive style, e.g. visits_store/round_id=171/zone_name=Resecentrum/). Columns are typed, and reads
+    push filters on zone, round and visit date down to the dataset so only matching files are opened.
+    """
+    SCHEMA = pa.schema([
+        ('user_name', pa.string()),
+        ('points', pa.int32()),
+        ('hold_time', pa.int64()),
+        ('visit_date', pa.timestamp('s')),
+    ])
+    PARTITIONING = ds.partitioning(pa.schema([('round_id', pa.int32()), ('zone_name', pa.string())]), flavor='hive')
+
+    def __init__(self, root: str='visits_store'):
+        self.root = root
+
+    def _dataset(self):
+        return ds.dataset(self.root, format='parquet', partitioning=self.PARTITIONING, schema=self._full_schema())
+
+    def _full_schema(self):
+        return pa.schema(list(self.SCHEMA) + list(self.PARTITIONING.schema))
+
+    def write(self, zone_name: str, round_id: int, visits_df: pd.DataFrame):
+        """Store (or replace) the visits of one zone and round"""
+        self.write_many({(zone_name, round_id): visits_df})
+
+    def write_many(self, visits: dict):
+        """Store (or replace) visits given as a dict mapping (zone_name, round_id) to a DataFrame"""
+        frames = []
+        for (zone_name, round_id), visits_df in visits.items():
+            if visits_df is None:
+                continue
+            df = visits_df[['user_name', 'points', 'hold_time', 'visit_date']].copy()
+            df['visit_date'] = pd.to_datetime(df['visit_date'])
+            df['round_id'] = round_id
+            df['zone_name'] = zone_name
+            frames.append(df)
+        if not frames:
+            return
+
+        table = pa.Table.from_pandas(pd.concat(frames, ignore_index=True), schema=self._full_schema(), preserve_index=False)
+        ds.write_dataset(table, self.root, format='parquet', partitioning=self.PARTITIONING,
+                         existing_data_behavior='delete_matching', basename_template='part-{i}.parquet')
+
+    def keys(self, round_ids=None):
+        """Set of stored (zone_name, round_id) pairs"""
+        if not os.path.exists(self.root):
+            return set()
+        filter = ds.field('round_id').isin(list(round_ids)) if round_ids is not None else None
+        fragments = self._dataset().get_fragments(filter=filter)
+        return {(expression['zone_name'], expression['round_id'])
+                for expression in (ds.get_partition_keys(fragment.partition_expression) for fragment in fragments)}
+
+    def read(self, zone_names=None, round_ids=None, start_date: datetime=None, end_date: datetime=None):
+        """
+        Read visits as one DataFrame with zone_name and round_id columns, optionally only for the given zones,
+        rounds and visits between start_date and end_date (inclusive).
+        """
+        if not os.path.exists(self.root):
+            return pd.DataFrame(columns=self._full_schema().names)
+
+        filter = None
+        conditions = []
+        if zone_names is not None:
+            conditions.append(ds.field('zone_name').isin(list(zone_names)))
+        if round_ids is not None:
+            conditions.append(ds.field('round_id').isin(list(round_ids)))
+        if start_date is not None:
+            conditions.append(ds.field('visit_date') >= pa.scalar(start_date, type=pa.timestamp('s')))
+        if end_date is not None:
+            conditions.append(ds.field('visit_date') <= pa.scalar(end_date, type=pa.timestamp('s')))
+        for condition in conditions:
+            filter = condition if filter is None else filter & condition
+
+        return self._dataset().to_table(filter=filter).to_pandas()
+
+    def read_many(self, zone_names, round_ids):
+        """Read visits for several zones and rounds in one read, as a dict mapping (zone_name, round_id) to a DataFrame"""
+        df = self.read(zone_names, round_ids)
+        return {(zone_name, round_id): group.drop(columns=['zone_name', 'round_id']).reset_index(drop=True)
+                for (zone_name, round_id), group in df.groupby(['zone_name', 'round_id'], sort=False)}
+
+    def import_csvs(self, directory: str='visits_data'):
+        """Import the old {zone_name}_{round_id}.csv files, returns the number of imported files"""
+        visits = {}
+        for filename in glob.glob(os.path.join(directory, '*.csv')):
+            zone_name, _, round_id = os.path.basename(filename)[:-len('.csv')].rpartition('_')
+            if not zone_name or not round_id.isdigit():
+                print(f"Skipping {filename}, not a visits file.")
+                continue
+            visits[(zone_name, int(round_id))] = pd.read_csv(filename)
+
+        self.write_many(visits)
+        print(f"Imported {len(visits)} visit files from {directory} to {self.root}.")
+        return len(visits)
+
+
+if __name__ == "__main__":
+    # Usage: python visitstore.py [CSV_DIRECTORY] [STORE_DIRECTORY]
+    csv_directory = sys.argv[1] if len(sys.argv) > 1 else 'visits_data'
+    store_directory = sys.argv[2] if len(sys.argv) > 2 else 'visits_store'
+    VisitStore(store_directory).import_csvs(csv_directory)
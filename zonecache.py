@@ -0,0 +1,148 @@
+import sqlite3
+from datetime import datetime, timedelta
+from typing import List
+
+from turfclasses import Coordinate, Takeover, User, Zone
+from util import TURF_TIME_FORMAT
+
+
+class ZoneCache:
+    """
+    Zones cached in a SQLite file, keyed by zone id and indexed on coordinates for area lookups.
+    Static attributes (name, coordinate, points, creation date) of each zone expire after static_ttl,
+    dynamic ones (owner and points per hour) after dynamic_ttl. Fetched areas are remembered, so an area
+    query can be answered from the cache if a larger or equal area was fetched within static_ttl.
+    """
+    def __init__(self, filename: str='zones.db', static_ttl: timedelta=timedelta(days=7),
+                 dynamic_ttl: timedelta=timedelta(minutes=10)):
+        self.filename = filename
+        self.static_ttl = static_ttl
+        self.dynamic_ttl = dynamic_ttl
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS zones (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                lat REAL NOT NULL,
+                lon REAL NOT NULL,
+                takeover_points INTEGER,
+                points_per_hour INTEGER,
+                date_created TEXT,
+                owner_id INTEGER,
+                owner_name TEXT,
+                static_updated REAL NOT NULL,
+                dynamic_updated REAL NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS zones_lat_lon ON zones (lat, lon)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS zones_name ON zones (name)")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS areas (
+                north REAL, east REAL, south REAL, west REAL, fetched REAL
+            )
+        """)
+        self.connection.commit()
+
+    def put_zones(self, zones: List[Zone], now: datetime=None):
+        """Store zones with all their attributes"""
+        timestamp = (now or datetime.now()).timestamp()
+        rows = [(zone.id, zone.name, zone.coordinate.lat, zone.coordinate.lon, zone.takeover_points,
+                 zone.points_per_hour, zone.date_created.strftime(TURF_TIME_FORMAT) if zone.date_created else None,
+                 zone.current_owner.id if zone.current_owner else None,
+                 zone.current_owner.name if zone.current_owner else None,
+                 timestamp, timestamp) for zone in zones]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO zones VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def update_dynamic(self, zones: List[Zone], now: datetime=None):
+        """Update only owner and points per hour of zones that are already cached"""
+        timestamp = (now or datetime.now()).timestamp()
+        rows = [(zone.current_owner.id if zone.current_owner else None,
+                 zone.current_owner.name if zone.current_owner else None,
+                 zone.points_per_hour, timestamp, zone.id) for zone in zones]
+        with self.connection:
+            self.connection.executemany("""
+                UPDATE zones SET owner_id = ?, owner_name = ?, points_per_hour = ?, dynamic_updated = ?
+                WHERE id = ?
+            """, rows)
+
+    def apply_takeovers(self, takeovers: List[Takeover]):
+        """
+        Set the owner of cached zones from takeovers, unless the zone was updated after the takeover.
+        Points per hour are kept if the takeover doesn't have them.
+        """
+        rows = [(takeover.user.id, takeover.user.name, takeover.zone.points_per_hour, takeover.time.timestamp(),
+                 takeover.zone.id, takeover.time.timestamp()) for takeover in takeovers]
+        with self.connection:
+            self.connection.executemany("""
+                UPDATE zones SET owner_id = ?, owner_name = ?, points_per_hour = COALESCE(?, points_per_hour),
+                                 dynamic_updated = ?
+                WHERE id = ? AND dynamic_updated <= ?
+            """, rows)
+
+    def add_area(self, north_east: Coordinate, south_west: Coordinate, now: datetime=None):
+        """Remember that all zones in an area were fetched"""
+        timestamp = (now or datetime.now()).timestamp()
+        with self.connection:
+            self.connection.execute("INSERT INTO areas VALUES (?, ?, ?, ?, ?)",
+                                    (north_east.lat, north_east.lon, south_west.lat, south_west.lon, timestamp))
+
+    def is_area_fresh(self, north_east: Coordinate, south_west: Coordinate, now: datetime=None):
+        """True if the area is inside an area that was fetched within static_ttl"""
+        oldest = (now or datetime.now()) - self.static_ttl
+        row = self.connection.execute("""
+            SELECT 1 FROM areas
+            WHERE north >= ? AND east >= ? AND south <= ? AND west <= ? AND fetched >= ?
+            LIMIT 1
+        """, (north_east.lat, north_east.lon, south_west.lat, south_west.lon, oldest.timestamp())).fetchone()
+        return row is not None
+
+    def zones_in_area(self, north_east: Coordinate, south_west: Coordinate):
+        """Cached zones inside an area"""
+        rows = self.connection.execute("""
+            SELECT * FROM zones WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?
+        """, (south_west.lat, north_east.lat, south_west.lon, north_east.lon)).fetchall()
+        return [self._zone_from_row(row) for row in rows]
+
+    def get(self, zone_id: int):
+        row = self.connection.execute("SELECT * FROM zones WHERE id = ?", (zone_id,)).fetchone()
+        return self._zone_from_row(row) if row else None
+
+    def get_by_name(self, name: str):
+        row = self.connection.execute("SELECT * FROM zones WHERE name = ?", (name,)).fetchone()
+        return self._zone_from_row(row) if row else None
+
+    def stale_static(self, zones: List[Zone], now: datetime=None):
+        """Zones whose static attributes are older than static_ttl"""
+        return self._stale(zones, 'static_updated', self.static_ttl, now)
+
+    def stale_dynamic(self, zones: List[Zone], now: datetime=None):
+        """Zones whose owner and points per hour are older than dynamic_ttl"""
+        return self._stale(zones, 'dynamic_updated', self.dynamic_ttl, now)
+
+    def _stale(self, zones: List[Zone], column: str, ttl: timedelta, now: datetime=None):
+        oldest = ((now or datetime.now()) - ttl).timestamp()
+        ids = [zone.id for zone in zones]
+        stale = set()
+        for k in range(0, len(ids), 500):
+            chunk = ids[k:k + 500]
+            rows = self.connection.execute(f"""
+                SELECT id FROM zones WHERE {column} < ? AND id IN ({','.join('?' * len(chunk))})
+            """, [oldest] + chunk).fetchall()
+            stale.update(row[0] for row in rows)
+        return [zone for zone in zones if zone.id in stale]
+
+    def _zone_from_row(self, row):
+        (id, name, lat, lon, takeover_points, points_per_hour, date_created,
+         owner_id, owner_name, _, _) = row
+        return Zone(
+            id=id,
+            name=name,
+            coordinate=Coordinate(lat, lon),
+            takeover_points=takeover_points,
+            points_per_hour=points_per_hour,
+            date_created=datetime.strptime(date_created, TURF_TIME_FORMAT) if date_created else None,
+            current_owner=User(owner_id, owner_name) if owner_id is not None else None
+        )
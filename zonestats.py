@@ -1,24 +1,80 @@
 from matplotlib import pyplot as plt
 from datetime import datetime
+import numpy as np
 import pandas as pd
 
+from zundin_scraper import ZundinScraper
+
+HOURS_PER_WEEK = 24 * 7
+
 class ZoneStats:
-    def __init__(self, zone_name, visits_df):
+    # Functions mapping a date to the bucket it shares estimates with
+    DATE_BUCKETS = {
+        'exact': lambda date: date,
+        'hour': lambda date: date.replace(minute=0, second=0, microsecond=0),
+        'hour_of_week': lambda date: date.weekday() * 24 + date.hour,
+        'day': lambda date: date.date(),
+    }
+
+    def __init__(self, zone_name, visits_df, date_bucket='hour_of_week'):
+        if date_bucket not in self.DATE_BUCKETS:
+            raise ValueError(f"Invalid date bucket, use one of {list(self.DATE_BUCKETS)}.")
         self.zone_name = zone_name
+        self.date_bucket = date_bucket
+
+        # Cache for estimate_hold_time, keyed by method and date bucket
+        self._hold_time_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
         self.visits_df = visits_df    # Takeovers + Assists
 
+    @property
+    def visits_df(self):
+        return self._visits_df
+
+    @visits_df.setter
+    def visits_df(self, visits_df):
+        # Derived time columns are computed once here and shared by all plots and estimators
+        visit_dates = pd.to_datetime(visits_df['visit_date'])
+        self._visits_df = visits_df.assign(visit_date=visit_dates,
+                                           hour_of_day=visit_dates.dt.hour,
+                                           weekday=visit_dates.dt.weekday,
+                                           hour_of_week=visit_dates.dt.weekday * 24 + visit_dates.dt.hour)
+
         # takeovers are where the hold_time > 0
-        self.takeovers_df = self.visits_df[self.visits_df['hold_time'] > 0]
-        self.assists_df = self.visits_df[self.visits_df['hold_time'] == 0]
+        self.takeovers_df = self._visits_df[self._visits_df['hold_time'] > 0]
+        self.assists_df = self._visits_df[self._visits_df['hold_time'] == 0]
+        self.hold_time_profile = None   # Estimated hold time for every hour of the week, see fit_hold_time_profiles
+        self.clear_cache()
+
+    @staticmethod
+    def from_rounds(zone_name, round_range, scraper=None):
+        """
+        Create stats from the visits of a zone over several rounds. All rounds are fetched with one
+        get_visits_data_many call (a single read if the scraper uses a VisitStore) and concatenated once.
+        Returns None if no visits were found for any of the rounds.
+        """
+        if scraper is None:
+            scraper = ZundinScraper()
+
+        round_ids = list(round_range)
+        visits = scraper.get_visits_data_many([zone_name], round_ids)
+        frames = [visits[(zone_name, round_id)] for round_id in round_ids if visits.get((zone_name, round_id)) is not None]
+        if not frames:
+            print(f"No visit data found for {zone_name} in rounds {round_ids}.")
+            return None
+        return ZoneStats(zone_name, pd.concat(frames, ignore_index=True))
+
+    def clear_cache(self):
+        self._hold_time_cache = {}
+
+    def cache_info(self):
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'size': len(self._hold_time_cache)}
 
     def hourly_histogram(self):
         """Plot the number of takeovers per hour of the day"""
-        df = self.takeovers_df.copy()
-
-        df['visit_date'] = pd.to_datetime(df['visit_date'])
-        df['hour_of_day'] = df['visit_date'].dt.hour
-        df['weekday'] = df['visit_date'].dt.weekday
-        df['hour_of_week'] = df['weekday'] * 24 + df['hour_of_day']
+        df = self.takeovers_df
 
         plt.figure(figsize=(10, 6))
         plt.hist(df['hour_of_week'], bins=range(0, 24*7 + 1), edgecolor='black')
@@ -30,10 +86,7 @@ class ZoneStats:
 
     def daily_histogram(self):
         """Plot the number of takeovers per day of the week"""
-        df = self.takeovers_df.copy()
-
-        df['visit_date'] = pd.to_datetime(df['visit_date'])
-        df['weekday'] = df['visit_date'].dt.weekday
+        df = self.takeovers_df
 
         plt.figure(figsize=(10, 6))
         plt.hist(df['weekday'], bins=range(0, 8), edgecolor='black')
@@ -48,17 +101,87 @@ class ZoneStats:
 
 
     def estimate_hold_time(self, date: datetime, method='mean'):
+        """Estimate the hold time in seconds, memoized per method and date bucket"""
+        if method == 'mean':
+            key = (method,)     # Does not depend on the date
+        else:
+            key = (method, self.DATE_BUCKETS[self.date_bucket](date))
+
+        if key in self._hold_time_cache:
+            self.cache_hits += 1
+            return self._hold_time_cache[key]
+        self.cache_misses += 1
+
         if method == 'mean':
-            return self._mean_hold_time()
+            hold_time = self._mean_hold_time()
         elif method == 'fourier':
-            return self._fourier_hold_time(date)
+            hold_time = self._fourier_hold_time(date)
         else:
             raise ValueError("Invalid method for estimating hold time.")
 
+        self._hold_time_cache[key] = hold_time
+        return hold_time
+
 
     def _mean_hold_time(self):
         return self.takeovers_df['hold_time'].mean()
 
 
     def _fourier_hold_time(self, date: datetime):
-        raise NotImplementedError("Fourier method not implemented yet.")
\ No newline at end of file
+        """
+        Hold time from the profile fitted by fit_hold_time_profiles, which should be called once for the stats
+        of all zones. If this zone's profile hasn't been fitted, it is fitted on its own as a fallback.
+        """
+        if self.hold_time_profile is None:
+            ZoneStats.fit_hold_time_profiles([self])
+        return self.hold_time_profile[date.weekday() * 24 + date.hour]
+
+
+    @staticmethod
+    def fit_hold_time_profiles(stats_list, weekly_harmonics=2, daily_harmonics=3, ridge=1.0):
+        """
+        Fit a smoothed hour of the week hold time profile for every ZoneStats in stats_list at once.
+        The profile is a constant plus low order Fourier terms with weekly and daily periods, fitted by
+        least squares to the hold times of all takeovers. The Fourier terms are shrunk towards zero by ridge,
+        so zones with few takeovers get a profile close to their mean hold time.
+        The resulting 168 entry arrays are stored in hold_time_profile.
+        """
+        if not stats_list:
+            return
+
+        # Design matrix with one row per hour of the week
+        hours = np.arange(HOURS_PER_WEEK)
+        columns = [np.ones(HOURS_PER_WEEK)]
+        for period, harmonics in ((HOURS_PER_WEEK, weekly_harmonics), (24, daily_harmonics)):
+            for k in range(1, harmonics + 1):
+                columns.append(np.cos(2 * np.pi * k * hours / period))
+                columns.append(np.sin(2 * np.pi * k * hours / period))
+        X = np.column_stack(columns)
+
+        # Takeover counts and hold time sums per zone and hour, from all zones in one pass
+        zone_indices = np.concatenate([np.full(len(stats.takeovers_df), k) for k, stats in enumerate(stats_list)])
+        hours_of_week = np.concatenate([stats.takeovers_df['hour_of_week'].to_numpy(dtype=np.int64) for stats in stats_list])
+        hold_times = np.concatenate([stats.takeovers_df['hold_time'].to_numpy(dtype=np.float64) for stats in stats_list])
+        bins = zone_indices * HOURS_PER_WEEK + hours_of_week
+        counts = np.bincount(bins, minlength=len(stats_list) * HOURS_PER_WEEK).reshape(len(stats_list), HOURS_PER_WEEK)
+        sums = np.bincount(bins, weights=hold_times, minlength=len(stats_list) * HOURS_PER_WEEK).reshape(len(stats_list), HOURS_PER_WEEK)
+
+        # Weighted least squares on the hourly bins gives the same fit as least squares on every takeover
+        penalty = ridge * np.eye(X.shape[1])
+        penalty[0, 0] = 0   # Don't shrink the mean
+        A = np.einsum('hp,zh,hq->zpq', X, counts, X) + penalty
+        b = sums @ X
+        empty = counts.sum(axis=1) == 0
+        A[empty] = np.eye(X.shape[1])
+
+        coefficients = np.linalg.solve(A, b[:, :, np.newaxis])[:, :, 0]
+        profiles = coefficients @ X.T
+
+        # Keep estimates positive, the fit can dip below zero for sparse zones
+        means = sums.sum(axis=1) / np.maximum(counts.sum(axis=1), 1)
+        profiles = np.maximum(profiles, 0.1 * means[:, np.newaxis])
+        profiles[empty] = np.nan
+
+        for stats, profile in zip(stats_list, profiles):
+            stats.hold_time_profile = profile
+            stats.clear_cache()
\ No newline at end of file
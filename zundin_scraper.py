@@ -1,44 +1,284 @@
 import requests
 from bs4 import BeautifulSoup
+import lxml.etree
+import lxml.html
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
+import multiprocessing
 import os
 
+from ratelimit import RateLimiter
 from turfclasses import Round
+from util import load_from_json, save_to_json
+from visitstore import VisitStore
+
+# Forking after pyarrow (used by the visit store) has started its threads crashes the workers, so
+# parse workers are started from a clean process
+_PARSE_CONTEXT = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
 
 class ZundinScraper:
     BASE_URL = "https://frut.zundin.se/zone.php?"
     ZUNDIN_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
-    def __init__(self):
-        pass
+    def __init__(self, base_url=BASE_URL, cache_dir='visits_data', max_concurrent_requests=4,
+                 requests_per_second=None, parse_workers=None, store: VisitStore=None, timeout: float=30):
+        """
+        max_concurrent_requests and requests_per_second keep get_visits_data_many polite towards zundin,
+        parse_workers is the number of processes used to parse the downloaded pages.
+        If store is given, visits are cached in the VisitStore instead of one CSV per zone and round.
+        timeout is in seconds per page download, a page that fails or times out counts as not fetched.
+        """
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.store = store
+        self.max_concurrent_requests = max_concurrent_requests
+        self.parse_workers = parse_workers
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(requests_per_second)
+
+        # Newest visit date and time of last fetch for every zone and round, used for delta scraping
+        state_dir = store.root if store is not None else cache_dir
+        self.state_file = f"{state_dir}/_scrape_state.json"
+        self.state = load_from_json(self.state_file) if os.path.exists(self.state_file) else {}
 
 
-    def get_visits_data(self, zone_name, round_id):
-        """Fetch historical visit data for a specific zone by its name and round ID"""
-        filename = f"visits_data/{zone_name}_{round_id}.csv"
+    def get_visits_data(self, zone_name, round_id, refresh=False):
+        """
+        Fetch historical visit data for a specific zone by its name and round ID.
+        With refresh, cached data for a round that was still in progress at the last fetch is updated
+        with the visits since the newest cached visit. Closed rounds are never fetched again.
+        """
+        key = (zone_name, round_id)
 
         # Check for cached data
-        if os.path.exists(filename):
-            print(f"{filename} already exists. Loading from file.")
-            return load_from_csv(filename)
+        cached = self._load_cached([key])
+        if key in cached and not (refresh and not self.is_round_closed(zone_name, round_id)):
+            return cached[key]
 
         # Scrape data from zundin
-        print(f"{filename} not found. Scraping from zundin.")
-        url = f"{self.BASE_URL}zonename={zone_name}&roundid={round_id}"
-        response = requests.get(url)
+        newer_than = self._newest_visit_date(key, cached.get(key))
+        if newer_than is None:
+            print(f"Visits for {zone_name} in round {round_id} not cached. Scraping from zundin.")
+        else:
+            print(f"Refreshing visits for {zone_name} in round {round_id} after {newer_than}.")
+
+        fetched_at = datetime.now()
+        html = self._download_visits_page(zone_name, round_id)
+        if html is None:
+            return cached.get(key)
+
+        df = self._parse_visits_data(html, round_id, newer_than)
+        if df is None:
+            return cached.get(key)
+        if newer_than is not None:
+            df = self._merge_visits(cached[key], df, newer_than)
+        self._save_visits({key: df})
+        self._update_state({key: df}, fetched_at)
+        return df
+
+
+    def get_visits_data_many(self, zone_names, round_ids, refresh=False):
+        """
+        Fetch visit data for every combination of zone names and round IDs (a single round ID also works).
+        Cached data is loaded directly, the rest is downloaded concurrently and parsed in a process pool.
+        With refresh, cached rounds that are not closed are updated with new visits, see get_visits_data.
+        Returns a dict mapping (zone_name, round_id) to a DataFrame, or None if the data could not be fetched.
+        """
+        if isinstance(round_ids, int):
+            round_ids = [round_ids]
+
+        keys = [(zone_name, round_id) for zone_name in zone_names for round_id in round_ids]
+        cached = self._load_cached(keys)
+        visits = dict(cached)
+        missing = [key for key in keys if key not in cached]
+        if refresh:
+            missing += [key for key in cached if not self.is_round_closed(*key)]
+
+        print(f"{len(cached)} visit files loaded from cache, scraping {len(missing)} from zundin.")
+        if not missing:
+            return visits
+
+        newer_than = {key: self._newest_visit_date(key, cached.get(key)) for key in missing}
+        fetched_at = datetime.now()
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as downloads, \
+             ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=_PARSE_CONTEXT) as parsers:
+            download_futures = {downloads.submit(self._download_visits_page, *key): key for key in missing}
+            parse_futures = {}
+            for future in as_completed(download_futures):
+                zone_name, round_id = download_futures[future]
+                html = future.result()
+                if html is None:
+                    visits.setdefault((zone_name, round_id), None)
+                    continue
+                parse_futures[parsers.submit(_parse_visits_page, html, round_id, newer_than[(zone_name, round_id)])] = (zone_name, round_id)
+
+            scraped = {}
+            for future in as_completed(parse_futures):
+                key = parse_futures[future]
+                try:
+                    df = future.result()
+                except Exception as e:
+                    # One bad page shouldn't lose the rest of the batch
+                    print(f"Error parsing visits for zone {key[0]} in round {key[1]}: {e}")
+                    df = None
+                if df is None:
+                    # Keep the cached visits if the page couldn't be parsed
+                    visits.setdefault(key, None)
+                    continue
+                if newer_than[key] is not None:
+                    df = self._merge_visits(cached[key], df, newer_than[key])
+                scraped[key] = df
+
+        self._save_visits(scraped)
+        self._update_state(scraped, fetched_at)
+        visits.update(scraped)
+        return visits
+
+
+    def is_round_closed(self, zone_name, round_id):
+        """A round is closed if the cached data was fetched after the round ended"""
+        state = self.state.get(f"{zone_name}|{round_id}", {})
+        return state.get('closed', False)
+
+
+    def _newest_visit_date(self, key, cached_df):
+        """Newest visit date string of cached data, or None if nothing is cached"""
+        if cached_df is None:
+            return None
+        state = self.state.get(f"{key[0]}|{key[1]}")
+        if state is not None and state.get('newest_visit_date'):
+            return state['newest_visit_date']
+        return self._max_visit_date(cached_df)
+
+
+    def _max_visit_date(self, df):
+        """Newest visit date as a string, ignoring the neutral visit added at round start"""
+        dates = pd.to_datetime(df.loc[df['user_name'] != 'neutral', 'visit_date'])
+        return dates.max().strftime(self.ZUNDIN_TIME_FORMAT) if len(dates) else None
+
+
+    def _merge_visits(self, cached_df, new_df, newer_than):
+        """
+        Replace cached visits from newer_than onwards with the newly parsed ones. The newest cached visit is
+        included, since its hold time was still running when it was cached.
+        """
+        cached_dates = pd.to_datetime(cached_df['visit_date'])
+        kept = cached_df[(cached_dates < pd.Timestamp(newer_than)) | (cached_df['user_name'] == 'neutral')]
+        new_df = new_df.copy()
+        if pd.api.types.is_datetime64_any_dtype(cached_df['visit_date']):
+            new_df['visit_date'] = pd.to_datetime(new_df['visit_date']).astype(cached_df['visit_date'].dtype)
+        return pd.concat([new_df, kept], ignore_index=True)
+
+
+    def _update_state(self, visits, fetched_at):
+        """Remember the newest visit and whether the round had ended when it was fetched"""
+        for (zone_name, round_id), df in visits.items():
+            if df is None:
+                continue
+            self.state[f"{zone_name}|{round_id}"] = {
+                'newest_visit_date': self._max_visit_date(df),
+                'fetched_at': fetched_at.strftime(self.ZUNDIN_TIME_FORMAT),
+                'closed': fetched_at > Round(round_id).end_date,
+            }
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        save_to_json(self.state, self.state_file)
+
+
+    def _load_cached(self, keys):
+        """Load cached visits for a list of (zone_name, round_id), returns a dict with the keys that were found"""
+        if self.store is not None:
+            found = self.store.read_many({zone_name for zone_name, _ in keys}, {round_id for _, round_id in keys})
+            return {key: found[key] for key in keys if key in found}
+
+        cached = {}
+        for zone_name, round_id in keys:
+            filename = self._visits_filename(zone_name, round_id)
+            if os.path.exists(filename):
+                cached[(zone_name, round_id)] = load_from_csv(filename)
+        return cached
+
+
+    def _save_visits(self, visits):
+        """Cache a dict mapping (zone_name, round_id) to visits, None values are skipped"""
+        visits = {key: df for key, df in visits.items() if df is not None}
+        if self.store is not None:
+            self.store.write_many(visits)
+            return
+
+        for (zone_name, round_id), df in visits.items():
+            save_to_csv(df, self._visits_filename(zone_name, round_id))
+
+
+    def _visits_filename(self, zone_name, round_id):
+        return f"{self.cache_dir}/{zone_name}_{round_id}.csv"
+
+
+    def _download_visits_page(self, zone_name, round_id):
+        """Download the zone.php page for a zone and round, returns None on failure"""
+        self.rate_limiter.acquire()
+        url = f"{self.base_url}zonename={zone_name}&roundid={round_id}"
+        try:
+            response = requests.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"Error fetching data for zone {zone_name}: {e}")
+            return None
         if response.status_code == 200:
-            df = self._parse_visits_data(response.text, round_id)
-            save_to_csv(df, filename)
-            return df
+            return response.text
         else:
             print(f"Error fetching data for zone {zone_name}: {response.status_code}")
             return None
 
 
-    def _parse_visits_data(self, html, round_id):
-        """Parse historical visit data from HTML"""
+    def _parse_visits_data(self, html, round_id, newer_than=None):
+        """
+        Parse historical visit data from HTML, walking the cells of each row once with lxml.
+        If newer_than is given, only visits at or after that date are parsed and no neutral visit is added.
+        """
+        try:
+            tree = lxml.html.fromstring(html)
+        except lxml.etree.ParserError:     # Empty or blank page
+            print("No visit data found.")
+            return None
+        takeovers = tree.get_element_by_id('roundTakeovers', None)
+        table = next(takeovers.iter('table'), None) if takeovers is not None else None
+        if table is None:
+            print("No visit data found.")
+            return None
+
+        user_names = []
+        points = []
+        hold_times = []
+        visit_dates = []
+        for tr in list(table.iter('tr'))[1:-1]:
+            tds = list(tr.iter('td'))
+            visit_date = next(tds[3].iter('script')).text_content().strip()[29:-4]
+            if newer_than is not None and visit_date < newer_than:  # Dates in this format sort as strings
+                continue
+            user_names.append(tds[0].text_content().strip())
+            points.append(int(tds[1].text_content().strip()))
+            hold_times.append(self.parse_hold_time(tds[2].text_content().strip()))
+            visit_dates.append(visit_date)
+
+        # Add neutral visit at the beginning of round
+        if newer_than is None:
+            round_start = Round.get_round_start(round_id)
+            user_names.append('neutral')
+            points.append(0)
+            hold_times.append(0)
+            visit_dates.append(round_start.strftime(self.ZUNDIN_TIME_FORMAT))
+
+        return pd.DataFrame({'user_name': user_names,
+                             'points': points,
+                             'hold_time': hold_times,
+                             'visit_date': visit_dates})
+
+
+    def _parse_visits_data_soup(self, html, round_id):
+        """Parse historical visit data from HTML with BeautifulSoup, slower reference for _parse_visits_data"""
         visits = []
         soup = BeautifulSoup(html, 'html.parser')
 
@@ -85,6 +325,11 @@ class ZundinScraper:
         return 24*3600*int(days) + 3600*int(hours) + 60*int(minutes) + int(seconds)
 
 
+def _parse_visits_page(html, round_id, newer_than=None):
+    """Parse a zone.php page in a worker process, the scraper itself holds a lock and can't be pickled"""
+    return ZundinScraper.__new__(ZundinScraper)._parse_visits_data(html, round_id, newer_than)
+
+
 def save_to_csv(df, filename):
     """Save dataframe to a CSV file"""
     df.to_csv(filename, index=False)